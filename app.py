@@ -13,26 +13,34 @@
 import os
 import json
 import uuid
-from datetime import datetime
+import hashlib
+from datetime import datetime, timedelta
 import re
 import time
 import shutil
+import sqlite3
 import webbrowser
-from threading import Timer, Thread
+import cProfile
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from threading import Timer, Thread, Lock, RLock
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
 
 # --- Qdrant Vector Database ---
 from qdrant_client import QdrantClient, models
 
 # --- Web Application Framework (Flask) ---
-from flask import Flask, render_template, request, jsonify, Response
+from flask import Flask, render_template, request, jsonify, Response, send_from_directory
 
 # --- LangChain & AI Libraries ---
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_qdrant import Qdrant
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from google.api_core.exceptions import ResourceExhausted
@@ -44,54 +52,130 @@ from watchdog.events import FileSystemEventHandler
 # --- Utilities ---
 from colorama import init, Fore, Style
 init(autoreset=True)
+from chunk_dedup import ChunkDeduplicator
+from lexical_index import LexicalIndex, looks_like_identifier, reciprocal_rank_fusion
+from chunking import (
+    CHAT_HISTORY_RAW_DIR, PROCESSED_HISTORY_DIR, DATA_DIR, PROCESSED_PDF_DIR,
+    KNOWLEDGE_BASE_COLLECTION_NAME, CHAT_HISTORY_COLLECTION_NAME,
+    file_sha256, get_artifact_path, discard_replaced_artifact, load_chunks_for_file,
+)
 
 
 # --- Configuration and Initialization ---
 from dotenv import load_dotenv
 load_dotenv()
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY not found in .env file.")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") # Checked when the server starts; offline tools like bulk_ingest.py do not need it
 
 app = Flask(__name__, template_folder='templates')
 app.secret_key = os.urandom(24)
 
 # --- Global Configuration ---
-CHAT_HISTORY_RAW_DIR = "chat_history"
-PROCESSED_HISTORY_DIR = os.path.join(CHAT_HISTORY_RAW_DIR, "Processed")
-DATA_DIR = "data"
-PROCESSED_PDF_DIR = os.path.join(DATA_DIR, "Processed")
+# File locations, chunk sizes and collection names live in chunking.py
 CONFIG_FILE = "./config.json"
+PROFILE_DIR = "profiles"
+PROFILE_MAX_RUNS = 50 # Older .pstats/.json pairs in PROFILE_DIR are deleted beyond this many
+INDEX_STATE_FILE = "./index_state.json"
+POINT_MANIFEST_DB = "./point_manifest.db"
 
 # --- Embedding Model Configuration ---
+# These are the *desired* settings. The model the live collections were actually built
+# with is recorded in INDEX_STATE_FILE; changing these only takes effect after a reindex.
 EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
 VECTOR_DIMENSION = 384
+LEGACY_EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2" # What every collection was built with before INDEX_STATE_FILE existed
 
-KNOWLEDGE_BASE_COLLECTION_NAME = "knowledge_base"
-CHAT_HISTORY_COLLECTION_NAME = "chat_history_db"
+# Fixed namespace for uuid5 point IDs. Changing it would orphan every existing point ID.
+POINT_ID_NAMESPACE = uuid.UUID("6f1c2a52-3d7e-4b8a-9c61-2f4e8d9a7b10")
+
+# --- Hybrid Retrieval Configuration ---
+LEXICAL_INDEX_DB = "./lexical_index.db"
+HYBRID_SEARCH_ENABLED = True      # Fuse BM25 and dense rankings with reciprocal rank fusion
+HYBRID_CANDIDATES = 20            # Candidates taken from each ranking before fusion
+RRF_K = 60                        # Standard RRF damping constant
+LEXICAL_FAST_PATH_ENABLED = True  # Answer short identifier lookups from BM25 alone, skipping the embedding model
+LEXICAL_FAST_PATH_MAX_TERMS = 3
+
+# --- Near-Duplicate Detection Configuration ---
+DEDUP_INDEX_DB = "./dedup_index.db"
+DEDUP_THRESHOLD = 0.85 # Estimated Jaccard similarity of word shingles at which a chunk counts as a duplicate
+DEDUP_COLLECTIONS = {KNOWLEDGE_BASE_COLLECTION_NAME} # Chat history is never deduplicated
+
+# --- Reindex Configuration ---
+REINDEX_BATCH_SIZE = 64           # Chunks embedded per batch during a reindex
+REINDEX_THROTTLE_SECONDS = 0.5    # Pause between batches so live chat traffic is not starved
+REINDEX_FILE_ATTEMPTS = 3         # Tries per file before the reindex gives up and keeps the old aliases
+ALIAS_CREATE_ATTEMPTS = 5         # Retries for creating an alias after its legacy collection was dropped
+REINDEX_ALLOWED_MODELS = {EMBEDDING_MODEL_NAME} # Models /api/admin/reindex may load; anything else is rejected
+
+# --- Retrieval Configuration ---
+RETRIEVAL_K = 5                   # Chunks retrieved from each collection per question
+PREFETCH_TTL_SECONDS = 30         # How long a speculative retrieval for a draft stays usable
+PREFETCH_MAX_WAIT_SECONDS = 5     # How long chat() waits for a prefetch that is still running
+
+# --- Chat History Compaction Configuration ---
+COMPACTION_INTERVAL_SECONDS = 6 * 60 * 60 # How often the background compaction job runs
+COMPACTION_MIN_AGE_DAYS = 30              # Conversations older than this are condensed into a summary memory
+COMPACTION_MAX_RAW_CONVERSATIONS = 200    # Beyond this many un-compacted conversations, the oldest are compacted early
+COMPACTION_MAX_HISTORY_POINTS = 20000     # Beyond this many vectors in chat_history_db, the oldest are compacted early
+COMPACTION_SUMMARY_MAX_WORDS = 250
+
+def load_index_state(client: QdrantClient):
+    """
+    Returns the embedding model/version the live collections were built with.
+    The first start records it in INDEX_STATE_FILE, so the configured constants are never
+    mistaken for it later: collections that already exist were built with
+    LEGACY_EMBEDDING_MODEL_NAME at the dimension Qdrant reports for them, while a fresh
+    install starts with the configured model.
+    """
+    if os.path.exists(INDEX_STATE_FILE):
+        with open(INDEX_STATE_FILE, 'r') as f: return json.load(f)
+    existing_names = {col.name for col in client.get_collections().collections} | {alias.alias_name for alias in client.get_aliases().aliases}
+    existing_dimensions = [
+        client.get_collection(collection_name=name).config.params.vectors.size
+        for name in (KNOWLEDGE_BASE_COLLECTION_NAME, CHAT_HISTORY_COLLECTION_NAME) if name in existing_names
+    ]
+    if existing_dimensions:
+        state = {"version": 0, "embedding_model_name": LEGACY_EMBEDDING_MODEL_NAME, "vector_dimension": existing_dimensions[0]}
+    else:
+        state = {"version": 0, "embedding_model_name": EMBEDDING_MODEL_NAME, "vector_dimension": VECTOR_DIMENSION}
+    save_index_state(state)
+    return state
+def save_index_state(state):
+    with open(INDEX_STATE_FILE, 'w') as f: json.dump(state, f, indent=4)
 
 # --- Global Variables for Chatbot Components ---
-llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash", google_api_key=GEMINI_API_KEY, temperature=0.3)
-embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
 qdrant_client = QdrantClient("http://localhost:6333")
-knowledge_base_retriever = None
-chat_history_retriever = None
+index_state = load_index_state(qdrant_client)
+llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash", google_api_key=GEMINI_API_KEY, temperature=0.3) if GEMINI_API_KEY else None
+embeddings = HuggingFaceEmbeddings(model_name=index_state["embedding_model_name"])
 generation_chain = None
+chunk_deduplicator = ChunkDeduplicator(DEDUP_INDEX_DB, threshold=DEDUP_THRESHOLD)
+lexical_index = LexicalIndex(LEXICAL_INDEX_DB)
+lexical_ready_collections = set() # Collections whose BM25 index has been checked against Qdrant
+pipeline_lock = RLock() # Held while a file is written to Qdrant, so a reindex can cut over between files
+pipeline_watcher_started = False
 
 
 # --- Automated Data Pipeline Logic (from create_embeddings.py) ---
 
 def ensure_collection_exists(client: QdrantClient, collection_name: str, vector_size: int):
-    """Ensures a Qdrant collection exists with the correct vector size."""
+    """Ensures a Qdrant collection (or alias) exists with the correct vector size."""
     try:
         existing_collections = [col.name for col in client.get_collections().collections]
-        if collection_name in existing_collections:
+        existing_aliases = [alias.alias_name for alias in client.get_aliases().aliases]
+        interrupted_migration = [name for name in existing_collections if re.fullmatch(rf"{re.escape(collection_name)}_v\d+", name)]
+        if collection_name in existing_collections or collection_name in existing_aliases:
             collection_info = client.get_collection(collection_name=collection_name)
             current_size = collection_info.config.params.vectors.size
             if current_size != vector_size:
-                print(Fore.RED + f"CRITICAL: Collection '{collection_name}' has wrong vector size {current_size}. Expected {vector_size}. Please fix manually.")
+                print(Fore.RED + f"CRITICAL: Collection '{collection_name}' has wrong vector size {current_size}. Expected {vector_size}. Start a reindex with POST /api/admin/reindex to migrate it.")
                 return False
             print(Fore.GREEN + f"Pipeline: Collection '{collection_name}' is ready.")
+        elif interrupted_migration:
+            # A reindex dropped the legacy collection but never created the alias; an empty
+            # collection under this name would hide the data in the versioned collection.
+            print(Fore.RED + f"CRITICAL: '{collection_name}' is missing but {sorted(interrupted_migration)} exist. Run POST /api/admin/reindex again to finish the migration.")
+            return False
         else:
             print(Fore.YELLOW + f"Pipeline: Collection '{collection_name}' not found. Creating...")
             client.create_collection(
@@ -99,15 +183,211 @@ def ensure_collection_exists(client: QdrantClient, collection_name: str, vector_
                 vectors_config=models.VectorParams(size=vector_size, distance=models.Distance.COSINE)
             )
             print(Fore.GREEN + f"Pipeline: Collection '{collection_name}' created.")
+        ensure_payload_indexes(client, collection_name)
         return True
     except Exception as e:
         print(Fore.RED + f"Pipeline: CRITICAL ERROR ensuring collection '{collection_name}': {e}")
         return False
 
+def ensure_payload_indexes(client: QdrantClient, collection_name: str):
+    """Creates the keyword payload indexes used for filtered deletes and searches (idempotent)."""
+    aliases = {alias.alias_name: alias.collection_name for alias in client.get_aliases().aliases}
+    physical_name = aliases.get(collection_name, collection_name)
+    client.create_payload_index(collection_name=physical_name, field_name="metadata.source_file", field_schema=models.PayloadSchemaType.KEYWORD)
+    client.create_payload_index(collection_name=physical_name, field_name="metadata.book", field_schema=models.PayloadSchemaType.KEYWORD)
+    client.create_payload_index(collection_name=physical_name, field_name="metadata.chapter", field_schema=models.PayloadSchemaType.KEYWORD)
+    client.create_payload_index(collection_name=physical_name, field_name="metadata.page", field_schema=models.PayloadSchemaType.INTEGER)
+
+def embed_chunks(chunks, embedding_model=None):
+    """Runs the embedding model (the live one by default) over a list of chunks and returns their vectors."""
+    return (embedding_model or embeddings).embed_documents([chunk.page_content for chunk in chunks])
+
+def chunk_point_id(chunk) -> str:
+    """Derives a stable point ID from (source_file, chunk_index, content hash)."""
+    content_hash = hashlib.sha256(chunk.page_content.encode('utf-8')).hexdigest()
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, f"{chunk.metadata['source_file']}:{chunk.metadata['chunk_index']}:{content_hash}"))
+
+def upsert_chunks(chunks, vectors, collection_name: str):
+    """
+    Upserts pre-embedded chunks using the same payload layout as the LangChain Qdrant store.
+    Point IDs are deterministic, so re-ingesting a file overwrites its points instead of duplicating them.
+    Returns the list of point IDs written.
+    """
+    if not chunks: return []
+    point_ids = [chunk_point_id(chunk) for chunk in chunks]
+    points = [
+        models.PointStruct(
+            id=point_id,
+            vector=vector,
+            payload={"page_content": chunk.page_content, "metadata": chunk.metadata},
+        )
+        for point_id, chunk, vector in zip(point_ids, chunks, vectors)
+    ]
+    qdrant_client.upsert(collection_name=collection_name, points=points, wait=True)
+    return point_ids
+
+
+# --- Point Manifest ---
+# Records which point IDs belong to each source file, keyed by the logical collection
+# name (alias), so a chat or PDF can be replaced or deleted by exact ID.
+
+def _manifest_connection():
+    conn = sqlite3.connect(POINT_MANIFEST_DB, timeout=30)
+    conn.execute("CREATE TABLE IF NOT EXISTS points (collection TEXT, source_file TEXT, point_id TEXT, PRIMARY KEY (collection, source_file, point_id))")
+    return conn
+
+def get_source_point_ids(collection_name: str, source_file: str):
+    conn = _manifest_connection()
+    try:
+        rows = conn.execute("SELECT point_id FROM points WHERE collection = ? AND source_file = ?", (collection_name, source_file)).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
+
+def record_source_points(collection_name: str, source_file: str, point_ids):
+    """Replaces the manifest entry for a source file with `point_ids` (an empty list removes it)."""
+    conn = _manifest_connection()
+    try:
+        with conn:
+            conn.execute("DELETE FROM points WHERE collection = ? AND source_file = ?", (collection_name, source_file))
+            conn.executemany("INSERT OR IGNORE INTO points VALUES (?, ?, ?)", [(collection_name, source_file, point_id) for point_id in point_ids])
+    finally:
+        conn.close()
+
+def reset_manifest_collection(collection_name: str, source_points: dict):
+    """Rewrites every manifest entry of a collection from a {source_file: [point_ids]} mapping."""
+    conn = _manifest_connection()
+    try:
+        with conn:
+            conn.execute("DELETE FROM points WHERE collection = ?", (collection_name,))
+            conn.executemany("INSERT OR IGNORE INTO points VALUES (?, ?, ?)", [
+                (collection_name, source_file, point_id) for source_file, point_ids in source_points.items() for point_id in point_ids
+            ])
+    finally:
+        conn.close()
+
+def _source_file_filter(source_file: str, keep_ids=None):
+    return models.Filter(
+        must=[models.FieldCondition(key="metadata.source_file", match=models.MatchValue(value=source_file))],
+        must_not=[models.HasIdCondition(has_id=list(keep_ids))] if keep_ids else None,
+    )
+
+def replace_source_points(collection_name: str, source_file: str, point_ids):
+    """Makes `point_ids` the complete set of points for a source file, deleting any stale ones."""
+    old_ids = get_source_point_ids(collection_name, source_file)
+    if old_ids:
+        stale_ids = sorted(set(old_ids) - set(point_ids))
+        if stale_ids:
+            qdrant_client.delete(collection_name=collection_name, points_selector=models.PointIdsList(points=stale_ids), wait=True)
+    else:
+        # Not in the manifest: a new file, or one ingested before IDs were deterministic.
+        # Clear any legacy random-ID points for it, keeping the ones just written.
+        qdrant_client.delete(collection_name=collection_name, points_selector=models.FilterSelector(filter=_source_file_filter(source_file, point_ids)), wait=True)
+    record_source_points(collection_name, source_file, point_ids)
+
+def delete_source_points(collection_name: str, source_file: str):
+    """Removes every point of a source file, by ID when the manifest knows them."""
+    point_ids = get_source_point_ids(collection_name, source_file)
+    if point_ids:
+        qdrant_client.delete(collection_name=collection_name, points_selector=models.PointIdsList(points=point_ids), wait=True)
+    else:
+        qdrant_client.delete(collection_name=collection_name, points_selector=models.FilterSelector(filter=_source_file_filter(source_file)), wait=True)
+    record_source_points(collection_name, source_file, [])
+    lexical_index.remove_source(collection_name, source_file)
+    if collection_name in DEDUP_COLLECTIONS:
+        forget_dedup_source(collection_name, source_file)
+
+
+# --- Near-Duplicate Detection ---
+# Chunks that nearly duplicate content already indexed from another file are skipped
+# before embedding; chunk_dedup.py keeps the MinHash/LSH index across runs.
+
+# Files whose skipped chunks lose their original are re-ingested in a background thread.
+# Callers that must wait for that (bulk_ingest.py exits when it is done) pass a `dependents`
+# set instead; the (collection, source_file) pairs are collected there for them to re-ingest.
+
+def deduplicate_chunks(chunks, collection_name: str, source_file: str, dependents=None):
+    """Returns the chunks of a source that are not near-duplicates of already indexed content."""
+    if collection_name not in DEDUP_COLLECTIONS or not chunks:
+        return chunks
+    kept, duplicate_count, orphaned_sources = chunk_deduplicator.deduplicate(collection_name, source_file, chunks)
+    if duplicate_count:
+        print(Fore.CYAN + f"Pipeline: Dedup skipped {duplicate_count}/{len(chunks)} near-duplicate chunks of '{source_file}' ({duplicate_count / len(chunks):.0%}).")
+    if orphaned_sources:
+        queue_dependent_reindex(collection_name, orphaned_sources, dependents)
+    return kept
+
+def forget_dedup_source(collection_name: str, source_file: str, dependents=None):
+    """Drops a source from the dedup index, re-ingesting any files that relied on its chunks."""
+    orphaned_sources = chunk_deduplicator.forget_source(collection_name, source_file)
+    if orphaned_sources:
+        queue_dependent_reindex(collection_name, orphaned_sources, dependents)
+
+def queue_dependent_reindex(collection_name: str, source_files, dependents=None):
+    if dependents is not None:
+        dependents.update((collection_name, source_file) for source_file in source_files)
+        return
+    print(Fore.YELLOW + f"Pipeline: Re-indexing {len(source_files)} file(s) whose duplicate chunks lost their original...")
+    Thread(target=reindex_dependent_sources, args=(collection_name, source_files), daemon=True).start()
+
+def reindex_dependent_sources(collection_name: str, source_files, dependents=None):
+    """Re-ingests processed files so the chunks they skipped as duplicates are indexed again."""
+    processed_dir = PROCESSED_PDF_DIR if collection_name == KNOWLEDGE_BASE_COLLECTION_NAME else PROCESSED_HISTORY_DIR
+    for source_file in source_files:
+        file_path = os.path.join(processed_dir, source_file)
+        if not os.path.exists(file_path): continue
+        try:
+            chunks, _ = load_chunks_for_file(file_path)
+            with pipeline_lock:
+                index_source_chunks(chunks, collection_name, source_file, dependents)
+            print(Fore.GREEN + f"Pipeline: Re-indexed '{source_file}'.")
+        except Exception as e:
+            print(Fore.RED + f"Pipeline ERROR re-indexing '{source_file}': {e}")
+
+def index_lexical_chunks(collection_name: str, source_file: str, chunks, point_ids):
+    """Replaces a source's entries in the BM25 index with its current chunks."""
+    lexical_index.replace_source(collection_name, source_file, [
+        (point_id, chunk.page_content, chunk.metadata) for point_id, chunk in zip(point_ids, chunks)
+    ])
+
+def backfill_lexical_index(collection_name: str):
+    """
+    Rebuilds a collection's BM25 index from the chunk payloads stored in Qdrant when their
+    counts differ, e.g. for chunks ingested before hybrid search existed. Until a collection
+    has been checked here, retrieval does not use the keyword-only fast path for it.
+    """
+    with pipeline_lock:
+        point_count = qdrant_client.count(collection_name=collection_name, exact=True).count
+        if lexical_index.count(collection_name) != point_count:
+            print(Fore.CYAN + f"Pipeline: Rebuilding the keyword index of '{collection_name}' from {point_count} Qdrant points...")
+            lexical_index.reset(collection_name)
+            offset = None
+            while True:
+                points, offset = qdrant_client.scroll(collection_name=collection_name, limit=256, offset=offset, with_payload=True, with_vectors=False)
+                lexical_index.add(collection_name, [
+                    (str(point.id), (point.payload or {}).get("page_content", ""), (point.payload or {}).get("metadata", {})) for point in points
+                ])
+                if offset is None: break
+            print(Fore.GREEN + f"Pipeline: Keyword index of '{collection_name}' rebuilt.")
+    lexical_ready_collections.add(collection_name)
+
+def index_source_chunks(chunks, collection_name: str, source_file: str, dependents=None):
+    """Deduplicates, embeds and upserts all chunks of one source, then records its point IDs."""
+    try:
+        chunks = deduplicate_chunks(chunks, collection_name, source_file, dependents)
+        point_ids = upsert_chunks(chunks, embed_chunks(chunks), collection_name)
+        replace_source_points(collection_name, source_file, point_ids)
+        index_lexical_chunks(collection_name, source_file, chunks, point_ids)
+    except Exception:
+        # The dedup index must never claim chunks that did not make it into Qdrant
+        if collection_name in DEDUP_COLLECTIONS:
+            forget_dedup_source(collection_name, source_file, dependents)
+        raise
+    return point_ids
+
 def process_file_for_qdrant(file_path: str):
     """Processes a single file (PDF or JSON) and uploads its chunks to Qdrant."""
     filename = os.path.basename(file_path)
-    source_dir = os.path.dirname(file_path)
     
     is_pdf = filename.lower().endswith('.pdf')
     collection_name = KNOWLEDGE_BASE_COLLECTION_NAME if is_pdf else CHAT_HISTORY_COLLECTION_NAME
@@ -115,45 +395,27 @@ def process_file_for_qdrant(file_path: str):
     
     print(Fore.CYAN + f"Pipeline: Processing '{filename}' for collection '{collection_name}'...")
 
-    try:
-        if is_pdf:
-            loader = PyPDFLoader(file_path)
-            documents = loader.load()
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            chunks = text_splitter.split_documents(documents)
-        else: # It's a JSON chat history
-            with open(file_path, 'r', encoding='utf-8') as f:
-                chat_data = json.load(f)
-            transcript = f"Chat Summary: {chat_data.get('summary', 'Untitled')}\n\n" + "\n".join(
-                [f"{item['role']}: {item['content']}" for item in chat_data.get('history', [])]
-            )
-            if not chat_data.get('history'):
-                print(Fore.YELLOW + "Pipeline: Skipping empty chat file.")
+    profile_context = profiled(f"ingest_{filename}", lambda: release_file_profile(filename)) if claim_file_profile(filename) else nullcontext()
+    with profile_context:
+        try:
+            chunks, collection_name = load_chunks_for_file(file_path)
+
+            if is_pdf:
+                discard_replaced_artifact(os.path.join(processed_dir, filename), file_sha256(file_path))
+
+            if not chunks:
+                print(Fore.YELLOW + f"Pipeline: No text chunks created for '{filename}', skipping.")
                 shutil.move(file_path, os.path.join(processed_dir, filename))
                 return
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            chunks = text_splitter.create_documents([transcript])
 
-        if not chunks:
-            print(Fore.YELLOW + f"Pipeline: No text chunks created for '{filename}', skipping.")
-            shutil.move(file_path, os.path.join(processed_dir, filename))
-            return
-            
-        for chunk in chunks:
-            chunk.metadata = {"source_file": filename}
-
-        Qdrant.from_documents(
-            documents=chunks,
-            embedding=embeddings,
-            url="http://localhost:6333",
-            collection_name=collection_name
-        )
-        print(Fore.GREEN + f"Pipeline: Successfully uploaded '{filename}' to Qdrant.")
-        shutil.move(file_path, os.path.join(processed_dir, filename))
-        print(Fore.GREEN + f"Pipeline: Moved '{filename}' to processed directory.")
+            with pipeline_lock:
+                index_source_chunks(chunks, collection_name, filename)
+                print(Fore.GREEN + f"Pipeline: Successfully uploaded '{filename}' to Qdrant.")
+                shutil.move(file_path, os.path.join(processed_dir, filename))
+                print(Fore.GREEN + f"Pipeline: Moved '{filename}' to processed directory.")
 
-    except Exception as e:
-        print(Fore.RED + f"Pipeline ERROR processing '{filename}': {e}")
+        except Exception as e:
+            print(Fore.RED + f"Pipeline ERROR processing '{filename}': {e}")
 
 class NewFileHandler(FileSystemEventHandler):
     """Event handler that triggers when a new file is created."""
@@ -166,6 +428,7 @@ class NewFileHandler(FileSystemEventHandler):
 
 def start_pipeline_watcher():
     """Initializes and starts the file system watcher in a background thread."""
+    global pipeline_watcher_started
     # Ensure all needed directories exist before starting
     os.makedirs(CHAT_HISTORY_RAW_DIR, exist_ok=True)
     os.makedirs(PROCESSED_HISTORY_DIR, exist_ok=True)
@@ -173,10 +436,18 @@ def start_pipeline_watcher():
     os.makedirs(PROCESSED_PDF_DIR, exist_ok=True)
 
     # Ensure Qdrant collections are ready
-    if not ensure_collection_exists(qdrant_client, KNOWLEDGE_BASE_COLLECTION_NAME, VECTOR_DIMENSION): return
-    if not ensure_collection_exists(qdrant_client, CHAT_HISTORY_COLLECTION_NAME, VECTOR_DIMENSION): return
+    if not ensure_collection_exists(qdrant_client, KNOWLEDGE_BASE_COLLECTION_NAME, index_state["vector_dimension"]): return
+    if not ensure_collection_exists(qdrant_client, CHAT_HISTORY_COLLECTION_NAME, index_state["vector_dimension"]): return
+    for collection_name in (KNOWLEDGE_BASE_COLLECTION_NAME, CHAT_HISTORY_COLLECTION_NAME):
+        try:
+            backfill_lexical_index(collection_name)
+        except Exception as e:
+            print(Fore.RED + f"Pipeline: Could not rebuild the keyword index of '{collection_name}', keyword-only search stays off: {e}")
+    if index_state["embedding_model_name"] != EMBEDDING_MODEL_NAME:
+        print(Fore.YELLOW + f"Pipeline: Serving with '{index_state['embedding_model_name']}' but '{EMBEDDING_MODEL_NAME}' is configured. Start a reindex with POST /api/admin/reindex to switch.")
 
     print(Style.BRIGHT + Fore.MAGENTA + "--- Starting Automated Data Pipeline Watcher ---")
+    pipeline_watcher_started = True
     event_handler = NewFileHandler()
     observer = Observer()
     # Watch both the raw chat history and the main data directory
@@ -185,6 +456,428 @@ def start_pipeline_watcher():
     observer.daemon = True
     observer.start()
     print(Style.BRIGHT + Fore.GREEN + "--- Watcher is now running in the background. ---")
+    Thread(target=compaction_loop, daemon=True).start()
+
+
+# --- On-Demand Profiling ---
+# Profiling is opt-in: POST /api/admin/profile arms it for the next N chat requests or for
+# a named file in the pipeline, and a single chat request can ask for it with an
+# 'X-Profile: 1' header. Each run writes a cProfile .pstats file (usable with snakeviz,
+# flameprof or gprof2dot for flamegraphs) and a .json sidecar with RSS and allocation data.
+
+profile_state = {"chat_requests": 0, "files": set()}
+profile_state_lock = Lock()
+profiler_lock = Lock() # Only one profile at a time: cProfile and tracemalloc are process-wide
+
+def claim_chat_profile(requested_by_header: bool) -> bool:
+    """Returns True if this chat request should be profiled, consuming one armed request if needed."""
+    with profile_state_lock:
+        if requested_by_header:
+            return True
+        if profile_state["chat_requests"] > 0:
+            profile_state["chat_requests"] -= 1
+            return True
+    return False
+
+def release_chat_profile():
+    """Gives back an armed chat request that could not be profiled."""
+    with profile_state_lock:
+        profile_state["chat_requests"] += 1
+
+def claim_file_profile(filename: str) -> bool:
+    """Returns True (once) if profiling was armed for this pipeline file."""
+    with profile_state_lock:
+        if filename in profile_state["files"]:
+            profile_state["files"].discard(filename)
+            return True
+    return False
+
+def release_file_profile(filename: str):
+    """Re-arms a pipeline file that could not be profiled."""
+    with profile_state_lock:
+        profile_state["files"].add(filename)
+
+def prune_profiles():
+    """Deletes the oldest profile runs beyond PROFILE_MAX_RUNS; file names start with a sortable timestamp."""
+    run_names = sorted({os.path.splitext(name)[0] for name in os.listdir(PROFILE_DIR) if name.endswith(('.pstats', '.json'))})
+    for run_name in run_names[:max(0, len(run_names) - PROFILE_MAX_RUNS)]:
+        for extension in ('.pstats', '.json'):
+            try: os.remove(os.path.join(PROFILE_DIR, run_name + extension))
+            except FileNotFoundError: pass
+
+def get_rss_bytes():
+    """Returns the current resident set size in bytes, or None where it cannot be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def get_peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == "Darwin" else peak * 1024 # Linux reports KB, macOS bytes
+
+@contextmanager
+def profiled(label: str, on_skip=None):
+    """
+    Profiles the enclosed block with cProfile and tracemalloc and saves the results to PROFILE_DIR.
+    If another profile is running the block runs unprofiled and on_skip is called to give back the claim.
+    """
+    if not profiler_lock.acquire(blocking=False):
+        print(Fore.YELLOW + f"Profiler: Another profile is running, skipping '{label}'.")
+        if on_skip: on_skip()
+        yield
+        return
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base_name = f"{datetime.now().strftime('%y%m%d%H%M%S')}_{uuid.uuid4().hex[:6]}_{re.sub(r'[^A-Za-z0-9_.-]', '_', label)[:80]}"
+        rss_before = get_rss_bytes()
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        start_time = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            duration = time.perf_counter() - start_time
+            snapshot = tracemalloc.take_snapshot()
+            traced_current, traced_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            profiler.dump_stats(os.path.join(PROFILE_DIR, f"{base_name}.pstats"))
+            report = {
+                "label": label,
+                "duration_seconds": duration,
+                "rss_before_bytes": rss_before,
+                "rss_after_bytes": get_rss_bytes(),
+                "peak_rss_bytes": get_peak_rss_bytes(),
+                "traced_alloc_current_bytes": traced_current,
+                "traced_alloc_peak_bytes": traced_peak,
+                "top_allocations": [
+                    {"location": str(stat.traceback), "size_bytes": stat.size, "count": stat.count}
+                    for stat in snapshot.statistics('lineno')[:25]
+                ],
+            }
+            with open(os.path.join(PROFILE_DIR, f"{base_name}.json"), 'w') as f:
+                json.dump(report, f, indent=4)
+            print(Fore.CYAN + f"Profiler: Saved '{base_name}' ({duration:.2f}s).")
+            prune_profiles()
+    finally:
+        profiler_lock.release()
+
+def profile_stream(stream, label: str, on_skip=None):
+    """Profiles a streaming response for as long as it is being consumed."""
+    with profiled(label, on_skip):
+        yield from stream
+
+
+# --- Chat History Compaction ---
+# Old conversations are condensed by the LLM into a short summary memory. The memory is
+# stored in the chat file and replaces the conversation's raw chunks in chat_history_db,
+# which keeps the collection (and history search latency) bounded over time.
+
+compaction_lock = Lock()
+compaction_status = {"state": "idle"}
+
+def _list_raw_conversations():
+    """Returns (timestamp, filename, chat_data) for every processed, not yet compacted conversation, oldest first."""
+    conversations = []
+    if not os.path.exists(PROCESSED_HISTORY_DIR):
+        return conversations
+    for filename in os.listdir(PROCESSED_HISTORY_DIR):
+        if not filename.lower().endswith(".json"): continue
+        try:
+            with open(os.path.join(PROCESSED_HISTORY_DIR, filename), 'r', encoding='utf-8') as f:
+                chat_data = json.load(f)
+            timestamp = datetime.fromisoformat(chat_data.get("timestamp", "1970-01-01T00:00:00"))
+        except (OSError, ValueError, TypeError, AttributeError): continue # Deleted meanwhile, unreadable, or malformed
+        if chat_data.get("history") and not chat_data.get("memory"):
+            conversations.append((timestamp, filename, chat_data))
+    conversations.sort(key=lambda item: item[0])
+    return conversations
+
+def summarize_conversation(chat_data) -> str:
+    """Asks the LLM to condense a conversation into a short memory."""
+    transcript = "\n".join(f"{item['role']}: {item['content']}" for item in chat_data.get("history", []))
+    prompt = (
+        f"Condense the following conversation into a compact memory for future reference, in at most "
+        f"{COMPACTION_SUMMARY_MAX_WORDS} words. Keep facts about the user, their preferences, decisions "
+        f"that were made and any unresolved topics. Leave out small talk.\n\n{transcript}"
+    )
+    return llm.invoke(prompt).content.strip()
+
+def compact_conversation(filename: str, chat_data):
+    """
+    Stores a summary memory in the chat file and replaces its raw chunks with summary vectors.
+    Returns the number of summary chunks, or None if the chat was deleted or changed while it was being summarized.
+    """
+    file_path = os.path.join(PROCESSED_HISTORY_DIR, filename)
+    memory = summarize_conversation(chat_data) # Slow LLM call, made without holding the pipeline lock
+    with pipeline_lock:
+        # The delete and update routes take the same lock, so the file cannot go away while it is rewritten
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                current_data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if current_data.get("history") != chat_data.get("history") or current_data.get("memory"):
+            return None
+        chat_data["memory"] = memory
+        chat_data["compacted_at"] = datetime.now().isoformat()
+        temp_path = file_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(chat_data, f, indent=4)
+        os.replace(temp_path, file_path)
+        chunks, collection_name = load_chunks_for_file(file_path)
+        index_source_chunks(chunks, collection_name, filename)
+    return len(chunks)
+
+def run_compaction():
+    """Compacts conversations that are too old, or the oldest ones while the configured size limits are exceeded."""
+    if not compaction_lock.acquire(blocking=False):
+        return
+    try:
+        conversations = _list_raw_conversations()
+        cutoff = datetime.now() - timedelta(days=COMPACTION_MIN_AGE_DAYS)
+        points_before = qdrant_client.count(collection_name=CHAT_HISTORY_COLLECTION_NAME, exact=True).count
+        points = points_before
+        compaction_status.clear()
+        compaction_status.update({"state": "running", "started_at": datetime.now().isoformat(), "compacted": 0, "errors": []})
+        raw_remaining = len(conversations)
+        for timestamp, filename, chat_data in conversations:
+            if timestamp >= cutoff and raw_remaining <= COMPACTION_MAX_RAW_CONVERSATIONS and points <= COMPACTION_MAX_HISTORY_POINTS:
+                break # Conversations are sorted oldest first, so nothing later qualifies either
+            try:
+                summary_chunks = compact_conversation(filename, chat_data)
+                if summary_chunks is None:
+                    print(Fore.YELLOW + f"Compaction: Skipped '{filename}', it was deleted or changed while being summarized.")
+                    continue
+                compaction_status["compacted"] += 1
+                raw_remaining -= 1
+                points = qdrant_client.count(collection_name=CHAT_HISTORY_COLLECTION_NAME, exact=True).count
+                print(Fore.GREEN + f"Compaction: Condensed '{filename}' into {summary_chunks} summary chunk(s).")
+            except ResourceExhausted:
+                print(Fore.YELLOW + "Compaction: API rate limit reached, resuming on the next run.")
+                break
+            except Exception as e:
+                print(Fore.RED + f"Compaction: ERROR compacting '{filename}': {e}")
+                compaction_status["errors"].append(f"{filename}: {e}")
+        compaction_status.update({"state": "completed", "points_before": points_before, "points_after": points, "finished_at": datetime.now().isoformat()})
+        if compaction_status["compacted"]:
+            print(Fore.GREEN + f"Compaction: {compaction_status['compacted']} conversation(s) compacted, chat_history_db {points_before} -> {points} vectors.")
+    except Exception as e:
+        print(Fore.RED + f"Compaction: CRITICAL ERROR: {e}")
+        compaction_status.update({"state": "failed", "error": str(e)})
+    finally:
+        compaction_lock.release()
+
+def compaction_loop():
+    """Runs the compaction job periodically for the lifetime of the app."""
+    while True:
+        run_compaction()
+        time.sleep(COMPACTION_INTERVAL_SECONDS)
+
+
+# --- Zero-Downtime Reindexing ---
+# A reindex builds fresh versioned collections from the Processed folders while the
+# current ones keep serving, then atomically repoints the aliases the retrievers read from.
+
+reindex_status = {"state": "idle"}
+reindex_lock = Lock()
+
+def get_alias_targets():
+    """Returns a dict of alias name -> physical collection name."""
+    return {alias.alias_name: alias.collection_name for alias in qdrant_client.get_aliases().aliases}
+
+def resolve_collection_name(name: str) -> str:
+    """Resolves an alias to the physical collection behind it (or returns the name unchanged)."""
+    return get_alias_targets().get(name, name)
+
+def list_processed_files():
+    """Returns the paths of every processed PDF and chat history file."""
+    files = []
+    for directory, extension in ((PROCESSED_PDF_DIR, '.pdf'), (PROCESSED_HISTORY_DIR, '.json')):
+        if os.path.exists(directory):
+            files.extend(os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.lower().endswith(extension))
+    return files
+
+def file_fingerprint(path: str):
+    """Cheap change detector: (inode, mtime, size) differs once a file is rewritten or replaced under the same name."""
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def swap_collection_aliases(alias_to_collection: dict):
+    """
+    Points each alias at its new collection. Returns {alias: previous collection} for the
+    previous collections that are kept and can be rolled back to.
+
+    Existing aliases are switched in a single atomic alias update. A pre-alias install instead
+    has real collections under these names, which must be dropped before the names can become
+    aliases: searches fail for that moment, and the old data cannot be rolled back to.
+    """
+    existing_collections = {col.name for col in qdrant_client.get_collections().collections}
+    current_aliases = get_alias_targets()
+    previous_collections, operations, legacy_names = {}, [], []
+    for alias_name, collection_name in alias_to_collection.items():
+        if alias_name in existing_collections:
+            legacy_names.append(alias_name)
+            continue
+        if alias_name in current_aliases:
+            previous_collections[alias_name] = current_aliases[alias_name]
+            operations.append(models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=alias_name)))
+        operations.append(models.CreateAliasOperation(create_alias=models.CreateAlias(collection_name=collection_name, alias_name=alias_name)))
+    if operations:
+        qdrant_client.update_collection_aliases(change_aliases_operations=operations)
+    for alias_name in legacy_names:
+        print(Fore.YELLOW + f"Reindex: Replacing legacy collection '{alias_name}' with an alias (one-time migration, no rollback).")
+        qdrant_client.delete_collection(collection_name=alias_name)
+        create_alias_with_retry(alias_name, alias_to_collection[alias_name])
+    return previous_collections
+
+def create_alias_with_retry(alias_name: str, collection_name: str):
+    """
+    Creates an alias whose name was just freed up. If it still fails, the data is safe in
+    `collection_name`; ensure_collection_exists then refuses to create an empty collection
+    under the name, and running the reindex again completes the migration.
+    """
+    for attempt in range(1, ALIAS_CREATE_ATTEMPTS + 1):
+        try:
+            qdrant_client.update_collection_aliases(change_aliases_operations=[
+                models.CreateAliasOperation(create_alias=models.CreateAlias(collection_name=collection_name, alias_name=alias_name))
+            ])
+            return
+        except Exception as e:
+            if attempt == ALIAS_CREATE_ATTEMPTS:
+                raise RuntimeError(f"Could not create alias '{alias_name}' -> '{collection_name}' after dropping the legacy collection ({e}). Run the reindex again to finish the migration.")
+            print(Fore.YELLOW + f"Reindex: Creating alias '{alias_name}' failed ({e}), retrying...")
+            time.sleep(attempt)
+
+def _reindex_file(file_path: str, collection_map: dict, target_embeddings):
+    """
+    Re-chunks one processed file and writes it into the new collection, in throttled batches.
+    Returns (alias_name, point_ids).
+    """
+    chunks, alias_name = load_chunks_for_file(file_path)
+    chunks = deduplicate_chunks(chunks, alias_name, os.path.basename(file_path))
+    point_ids = []
+    for start in range(0, len(chunks), REINDEX_BATCH_SIZE):
+        batch = chunks[start:start + REINDEX_BATCH_SIZE]
+        point_ids.extend(upsert_chunks(batch, embed_chunks(batch, target_embeddings), collection_map[alias_name]))
+        time.sleep(REINDEX_THROTTLE_SECONDS)
+    index_lexical_chunks(collection_map[alias_name], os.path.basename(file_path), chunks, point_ids)
+    return alias_name, point_ids
+
+def run_reindex_job(model_name: str):
+    """Builds versioned collections with `model_name`, then swaps the aliases over to them."""
+    global embeddings, index_state, generation_chain
+    try:
+        # Never rebuild a collection an alias points at, even if an interrupted migration left index_state behind
+        alias_versions = [int(match.group(1)) for target in get_alias_targets().values() if (match := re.search(r"_v(\d+)$", target))]
+        new_version = max([index_state["version"]] + alias_versions) + 1
+        collection_map = {
+            KNOWLEDGE_BASE_COLLECTION_NAME: f"{KNOWLEDGE_BASE_COLLECTION_NAME}_v{new_version}",
+            CHAT_HISTORY_COLLECTION_NAME: f"{CHAT_HISTORY_COLLECTION_NAME}_v{new_version}",
+        }
+        if model_name == index_state["embedding_model_name"]:
+            target_embeddings = embeddings
+        else:
+            print(Fore.CYAN + f"Reindex: Loading embedding model '{model_name}'...")
+            target_embeddings = HuggingFaceEmbeddings(model_name=model_name)
+        vector_dimension = len(target_embeddings.embed_query("dimension probe"))
+
+        for collection_name in collection_map.values():
+            # recreate_collection also clears leftovers from an earlier, interrupted attempt
+            qdrant_client.recreate_collection(collection_name=collection_name, vectors_config=models.VectorParams(size=vector_dimension, distance=models.Distance.COSINE))
+            ensure_payload_indexes(qdrant_client, collection_name)
+            lexical_index.reset(collection_name)
+        reindex_status.update({"state": "running", "version": new_version, "model": model_name, "files_done": 0, "chunks_done": 0, "errors": []})
+        print(Style.BRIGHT + Fore.MAGENTA + f"--- Reindex v{new_version} started with '{model_name}' ({vector_dimension} dims) ---")
+
+        source_points = {alias_name: {} for alias_name in collection_map}
+
+        failures = {} # path -> (fingerprint, attempts, error) of files that could not be copied yet
+
+        def reindex_pending(done_files):
+            """
+            Copies every processed file that is new or changed since it was copied (e.g. compacted),
+            retrying failed ones up to REINDEX_FILE_ATTEMPTS times. Returns how many were attempted.
+            """
+            pending = []
+            for path in list_processed_files():
+                try:
+                    fingerprint = file_fingerprint(path)
+                except OSError:
+                    continue # Deleted in the meantime
+                failure = failures.get(path)
+                if done_files.get(path) == fingerprint or (failure and failure[0] == fingerprint and failure[1] >= REINDEX_FILE_ATTEMPTS):
+                    continue
+                pending.append((path, fingerprint))
+            for path, fingerprint in pending:
+                try:
+                    alias_name, point_ids = _reindex_file(path, collection_map, target_embeddings)
+                    stale_ids = sorted(set(source_points[alias_name].get(os.path.basename(path), ())) - set(point_ids))
+                    if stale_ids:
+                        qdrant_client.delete(collection_name=collection_map[alias_name], points_selector=models.PointIdsList(points=stale_ids), wait=True)
+                    source_points[alias_name][os.path.basename(path)] = point_ids
+                    reindex_status["chunks_done"] += len(point_ids)
+                    done_files[path] = fingerprint
+                    failures.pop(path, None)
+                except Exception as e:
+                    failure = failures.get(path)
+                    attempts = failure[1] + 1 if failure and failure[0] == fingerprint else 1
+                    failures[path] = (fingerprint, attempts, str(e))
+                    print(Fore.RED + f"Reindex: ERROR processing '{path}' (attempt {attempts}/{REINDEX_FILE_ATTEMPTS}): {e}")
+                    reindex_status["errors"].append(f"{os.path.basename(path)}: {e}")
+                reindex_status["files_done"] = len(done_files)
+            return len(pending)
+
+        # Copy everything while live traffic continues, repeating until no file appeared or changed.
+        done_files = {} # path -> fingerprint of the version that was copied
+        while reindex_pending(done_files): pass
+
+        # Final catch-up and cut-over while the pipeline is paused between files.
+        with pipeline_lock:
+            while reindex_pending(done_files): pass
+            # A file missing from the new collections would vanish from live search at the swap
+            failed_files = sorted(os.path.basename(path) for path in failures if os.path.exists(path))
+            if failed_files:
+                raise RuntimeError(f"{len(failed_files)} file(s) could not be copied after {REINDEX_FILE_ATTEMPTS} attempts: {', '.join(failed_files)}. Aliases left unchanged.")
+            # Sources deleted while the copy was running must not reappear after the swap
+            for path in done_files:
+                if os.path.exists(path): continue
+                for alias_name, collection_name in collection_map.items():
+                    stale_ids = source_points[alias_name].pop(os.path.basename(path), None)
+                    lexical_index.remove_source(collection_name, os.path.basename(path))
+                    if stale_ids:
+                        qdrant_client.delete(collection_name=collection_name, points_selector=models.PointIdsList(points=stale_ids), wait=True)
+            previous_collections = swap_collection_aliases(collection_map)
+            for alias_name, points_by_source in source_points.items():
+                reset_manifest_collection(alias_name, points_by_source)
+                lexical_index.rename_collection(collection_map[alias_name], alias_name)
+            embeddings = target_embeddings
+            index_state = {"version": new_version, "embedding_model_name": model_name, "vector_dimension": vector_dimension}
+            save_index_state(index_state)
+            generation_chain = None # Chatbot components are rebuilt on the next request
+
+        # The previous version is kept for rollback; anything older is dropped.
+        existing_collections = {col.name for col in qdrant_client.get_collections().collections}
+        for alias_name in collection_map:
+            for version in range(1, new_version - 1):
+                stale_name = f"{alias_name}_v{version}"
+                if stale_name in existing_collections:
+                    qdrant_client.delete_collection(collection_name=stale_name)
+        reindex_status.update({"state": "completed", "previous_collections": previous_collections, "finished_at": datetime.now().isoformat()})
+        print(Style.BRIGHT + Fore.GREEN + f"--- Reindex v{new_version} complete. Aliases now point at the new collections. ---")
+        if not pipeline_watcher_started and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            # The watcher refused to start against collections of the wrong dimension; they are fixed now
+            Thread(target=start_pipeline_watcher, daemon=True).start()
+    except Exception as e:
+        print(Fore.RED + f"Reindex: CRITICAL ERROR: {e}")
+        reindex_status.update({"state": "failed", "error": str(e)})
+    finally:
+        reindex_lock.release()
 
 
 # --- Flask Web App Logic ---
@@ -229,16 +922,145 @@ def save_new_chat_for_processing(history_messages, summary="Untitled Chat"):
     # The watcher will now automatically pick this file up!
     return history_file_path
 
+
+# --- Retrieval & Speculative Prefetch ---
+# The frontend sends the debounced draft to /api/prefetch while the user is typing, so the
+# query embedding and both Qdrant searches are usually finished before /api/chat is called.
+
+prefetch_executor = ThreadPoolExecutor(max_workers=2)
+prefetch_cache = {} # session_id -> {"query": normalized draft, "scope": scope, "future": Future, "created": time}
+prefetch_lock = Lock()
+
+def build_scope_filter(scope):
+    """
+    Turns an optional {"book": ..., "chapter": ...} scope into a Qdrant payload filter.
+    Chunks skipped as near-duplicates of another book have no point of their own, so a scope only
+    matches them under the book that was indexed first.
+    """
+    if not scope:
+        return None
+    conditions = [
+        models.FieldCondition(key=f"metadata.{field}", match=models.MatchValue(value=scope[field]))
+        for field in ("book", "chapter") if scope.get(field)
+    ]
+    return models.Filter(must=conditions) if conditions else None
+
+def parse_scope(raw_scope):
+    """Validates a scope from a request body. Returns (scope, error_message)."""
+    if raw_scope is None:
+        return None, None
+    if not isinstance(raw_scope, dict) or not all(isinstance(raw_scope.get(field, ""), str) for field in ("book", "chapter")):
+        return None, "Scope must be an object with optional 'book' and 'chapter' strings."
+    scope = {field: raw_scope[field].strip() for field in ("book", "chapter") if raw_scope.get(field, "").strip()}
+    return scope or None, None
+
+def _point_to_document(point):
+    payload = point.payload or {}
+    return Document(page_content=payload.get("page_content", ""), metadata=payload.get("metadata", {}))
+
+def dense_search(collection_name: str, query_vector, limit: int, query_filter=None):
+    """Returns [(point_id, Document), ...] from a vector search, best first."""
+    points = qdrant_client.query_points(collection_name=collection_name, query=query_vector, query_filter=query_filter, limit=limit, with_payload=True).points
+    return [(str(point.id), _point_to_document(point)) for point in points]
+
+def fetch_documents(collection_name: str, point_ids):
+    """Loads chunks by point ID (no vector search), keeping the order of `point_ids`."""
+    if not point_ids:
+        return []
+    points = qdrant_client.retrieve(collection_name=collection_name, ids=point_ids, with_payload=True)
+    documents = {str(point.id): _point_to_document(point) for point in points}
+    return [(point_id, documents[point_id]) for point_id in point_ids if point_id in documents]
+
+def is_keyword_query(query: str) -> bool:
+    """Short lookups of an identifier (E1234, load_config, QdrantClient); chat turns like "why?" or "and chapter 2" are not."""
+    words = re.findall(r'\w+', query)
+    return LEXICAL_FAST_PATH_ENABLED and 0 < len(words) <= LEXICAL_FAST_PATH_MAX_TERMS and any(looks_like_identifier(word) for word in words)
+
+def retrieve_context(query: str, scope=None):
+    """
+    Retrieves the top chunks from both collections. A scope restricts the knowledge base
+    search to one book and/or chapter.
+
+    For short keyword queries, a collection whose BM25 index is complete and has matches is
+    answered from BM25 alone. Every other collection is searched with the query embedding
+    (computed at most once) and, with hybrid search enabled, its dense and BM25 rankings are
+    combined with reciprocal rank fusion.
+    """
+    searches = ((KNOWLEDGE_BASE_COLLECTION_NAME, scope), (CHAT_HISTORY_COLLECTION_NAME, None))
+    keyword_query = is_keyword_query(query)
+    lexical_rankings = {}
+    if HYBRID_SEARCH_ENABLED or keyword_query:
+        lexical_rankings = {
+            collection_name: [point_id for point_id, _ in lexical_index.search(collection_name, query, HYBRID_CANDIDATES, collection_scope)]
+            for collection_name, collection_scope in searches
+        }
+
+    query_vector = None
+    context_docs = []
+    for collection_name, collection_scope in searches:
+        if keyword_query and lexical_rankings[collection_name] and collection_name in lexical_ready_collections:
+            context_docs.extend(document for _, document in fetch_documents(collection_name, lexical_rankings[collection_name][:RETRIEVAL_K]))
+            continue
+        if query_vector is None:
+            query_vector = embeddings.embed_query(query)
+        dense_limit = HYBRID_CANDIDATES if HYBRID_SEARCH_ENABLED else RETRIEVAL_K
+        dense_results = dense_search(collection_name, query_vector, dense_limit, build_scope_filter(collection_scope))
+        if not HYBRID_SEARCH_ENABLED:
+            context_docs.extend(document for _, document in dense_results)
+            continue
+        fused_ids = reciprocal_rank_fusion([[point_id for point_id, _ in dense_results], lexical_rankings[collection_name]], RETRIEVAL_K, k=RRF_K)
+        documents = dict(dense_results)
+        documents.update(fetch_documents(collection_name, [point_id for point_id in fused_ids if point_id not in documents]))
+        context_docs.extend(documents[point_id] for point_id in fused_ids if point_id in documents)
+    return context_docs
+
+def _normalize_query(text: str) -> str:
+    """The query's words only; drafts that differ just in spacing or punctuation retrieve the same context."""
+    return " ".join(re.findall(r'\w+', text))
+
+def start_prefetch(session_id: str, draft: str, scope=None):
+    """
+    Starts a background retrieval for a draft, unless an identical one is already cached.
+    At most one retrieval per session is in flight: a queued one for an older draft is
+    cancelled, and while one is already running the new draft is not submitted.
+    """
+    query = _normalize_query(draft)
+    now = time.time()
+    with prefetch_lock:
+        for stale_session in [key for key, entry in prefetch_cache.items() if now - entry["created"] > PREFETCH_TTL_SECONDS]:
+            prefetch_cache.pop(stale_session)["future"].cancel()
+        entry = prefetch_cache.get(session_id)
+        if entry and entry["query"] == query and entry["scope"] == scope:
+            return
+        if entry and not entry["future"].done() and not entry["future"].cancel():
+            return # Still running; the next debounced draft is submitted once it has finished
+        prefetch_cache[session_id] = {"query": query, "scope": scope, "future": prefetch_executor.submit(retrieve_context, draft, scope), "created": now}
+
+def take_prefetched_context(session_id, message: str, scope=None):
+    """
+    Returns the prefetched documents for this session if the draft has the same words as the
+    final message. Near matches are not enough: "chapter 3" and "chapter 4" need different context.
+    """
+    if not session_id:
+        return None
+    with prefetch_lock:
+        entry = prefetch_cache.pop(session_id, None)
+    if not entry or entry["scope"] != scope or time.time() - entry["created"] > PREFETCH_TTL_SECONDS:
+        return None
+    query = _normalize_query(message)
+    if query != entry["query"]:
+        return None
+    try:
+        return entry["future"].result(timeout=PREFETCH_MAX_WAIT_SECONDS)
+    except Exception:
+        return None # Fall back to a fresh retrieval
+
 @app.before_request
 def initialize_chatbot_components():
-    global knowledge_base_retriever, chat_history_retriever, generation_chain
+    global generation_chain
     if generation_chain is not None: return
     try:
         print(Fore.YELLOW + "Initializing chatbot components...")
-        knowledge_base_store = Qdrant(client=qdrant_client, collection_name=KNOWLEDGE_BASE_COLLECTION_NAME, embeddings=embeddings)
-        knowledge_base_retriever = knowledge_base_store.as_retriever(search_kwargs={"k": 5})
-        chat_history_store = Qdrant(client=qdrant_client, collection_name=CHAT_HISTORY_COLLECTION_NAME, embeddings=embeddings)
-        chat_history_retriever = chat_history_store.as_retriever(search_kwargs={"k": 5})
         doc_chain_prompt = ChatPromptTemplate.from_messages([
             ("system", "{persona_instructions}\n\nYou are a helpful AI assistant. Answer based ONLY on the context provided below.\n\nContext:\n{context}"),
             MessagesPlaceholder(variable_name="chat_history"),
@@ -259,17 +1081,24 @@ def chat():
     data = request.json
     user_message = data.get('message')
     frontend_history = data.get('history', [])
+    session_id = data.get('session_id')
+    scope, scope_error = parse_scope(data.get('scope'))
+    if scope_error: return jsonify({"response": scope_error}), 400
     if not user_message: return jsonify({"response": "No message."}), 400
     if not generation_chain: return jsonify({"response": "Chatbot not ready."}), 503
     config = load_config()
     persona_instructions = config.get("persona_instructions", "You are a helpful AI assistant.")
     lc_chat_history = [HumanMessage(content=msg['content']) if msg['role'] == 'user' else AIMessage(content=msg['content']) for msg in frontend_history]
+    requested_by_header = request.headers.get('X-Profile') == '1'
+    profile_requested = claim_chat_profile(requested_by_header)
 
     def generate_response():
         try:
-            knowledge_docs = knowledge_base_retriever.invoke(user_message)
-            history_docs = chat_history_retriever.invoke(user_message)
-            stream = generation_chain.stream({"input": user_message, "chat_history": lc_chat_history, "context": knowledge_docs + history_docs, "persona_instructions": persona_instructions})
+            # A profiled request measures the full retrieval, not a cache hit
+            context_docs = None if profile_requested else take_prefetched_context(session_id, user_message, scope)
+            if context_docs is None:
+                context_docs = retrieve_context(user_message, scope)
+            stream = generation_chain.stream({"input": user_message, "chat_history": lc_chat_history, "context": context_docs, "persona_instructions": persona_instructions})
             for chunk in stream:
                 if isinstance(chunk, str) and chunk: yield f"event: message\ndata: {json.dumps({'content': chunk})}\n\n"
         except ResourceExhausted as e:
@@ -278,7 +1107,22 @@ def chat():
             yield f"event: message\ndata: {json.dumps({'content': 'An error occurred.', 'error': True})}\n\n"
         finally:
             yield "event: end\ndata: {}\n\n"
-    return Response(generate_response(), mimetype='text/event-stream')
+    if profile_requested:
+        response_stream = profile_stream(generate_response(), "chat", None if requested_by_header else release_chat_profile)
+    else:
+        response_stream = generate_response()
+    return Response(response_stream, mimetype='text/event-stream')
+@app.route('/api/prefetch', methods=['POST'])
+def api_prefetch():
+    data = request.json
+    session_id = data.get('session_id')
+    draft = (data.get('draft') or '').strip()
+    scope, scope_error = parse_scope(data.get('scope'))
+    if scope_error: return jsonify({"status": "error", "message": scope_error}), 400
+    if not session_id or not draft: return jsonify({"status": "ignored"}), 200
+    if not generation_chain: return jsonify({"status": "error", "message": "Chatbot not ready."}), 503
+    start_prefetch(session_id, draft, scope)
+    return jsonify({"status": "success"}), 202
 @app.route('/api/history/list', methods=['GET'])
 def api_history_list():
     return jsonify({"status": "success", "files": get_all_chat_summaries_and_filenames()})
@@ -300,20 +1144,13 @@ def api_history_update():
         return jsonify({"status": "error", "message": "Missing history or original filename."}), 400
     print(Fore.YELLOW + f"Web: Updating chat history for '{original_filename}'...")
     try:
-        print(Fore.CYAN + f"  -> Deleting old vectors from Qdrant where source is '{original_filename}'...")
-        qdrant_client.delete(
-            collection_name=CHAT_HISTORY_COLLECTION_NAME,
-            points_selector=models.FilterSelector(
-                filter=models.Filter(
-                    must=[models.FieldCondition(key="payload.source_file", match=models.MatchValue(value=original_filename))]
-                )
-            ),
-            wait=True,
-        )
-        old_file_path = os.path.join(PROCESSED_HISTORY_DIR, original_filename)
-        if os.path.exists(old_file_path):
-            print(Fore.CYAN + f"  -> Deleting old file: '{old_file_path}'")
-            os.remove(old_file_path)
+        with pipeline_lock: # Keeps compaction from writing the old chat back while it is removed
+            print(Fore.CYAN + f"  -> Deleting old vectors from Qdrant where source is '{original_filename}'...")
+            delete_source_points(CHAT_HISTORY_COLLECTION_NAME, original_filename)
+            old_file_path = os.path.join(PROCESSED_HISTORY_DIR, original_filename)
+            if os.path.exists(old_file_path):
+                print(Fore.CYAN + f"  -> Deleting old file: '{old_file_path}'")
+                os.remove(old_file_path)
         first_user_message = next((msg['content'].strip()[:30] for msg in history_to_save if msg.get('role') == 'user' and msg.get('content','').strip()), "Untitled Chat")
         summary_for_display = first_user_message.replace("_", " ").title()
         save_new_chat_for_processing(history_to_save, summary=summary_for_display)
@@ -329,17 +1166,101 @@ def api_history_load():
     if not filename: return jsonify({"status": "error"}), 400
     history = load_chat_history_from_file(filename)
     return jsonify({"status": "success", "history": history, "filename": filename}) if history else jsonify({"status": "error"}), 404
+@app.route('/api/history/delete', methods=['POST'])
+def api_history_delete():
+    data = request.json
+    filename = data.get('filename')
+    if not filename or os.path.basename(filename) != filename: return jsonify({"status": "error", "message": "Invalid filename."}), 400
+    try:
+        with pipeline_lock: # Keeps compaction from writing the chat back while it is removed
+            delete_source_points(CHAT_HISTORY_COLLECTION_NAME, filename)
+            file_path = os.path.join(PROCESSED_HISTORY_DIR, filename)
+            if os.path.exists(file_path): os.remove(file_path)
+        print(Fore.GREEN + f"Web: Deleted chat '{filename}' and its vectors.")
+        return jsonify({"status": "success"})
+    except Exception as e:
+        print(Fore.RED + f"Web: An error occurred while deleting '{filename}': {e}")
+        return jsonify({"status": "error", "message": "An internal error occurred."}), 500
+@app.route('/api/knowledge/delete', methods=['POST'])
+def api_knowledge_delete():
+    data = request.json
+    filename = data.get('filename')
+    if not filename or os.path.basename(filename) != filename: return jsonify({"status": "error", "message": "Invalid filename."}), 400
+    try:
+        with pipeline_lock: # Keeps the pipeline and a reindex cut-over from indexing the document again while it is removed
+            delete_source_points(KNOWLEDGE_BASE_COLLECTION_NAME, filename)
+            file_path = os.path.join(PROCESSED_PDF_DIR, filename)
+            if os.path.exists(file_path):
+                artifact_path = get_artifact_path(file_sha256(file_path))
+                if os.path.exists(artifact_path): os.remove(artifact_path)
+                os.remove(file_path)
+        print(Fore.GREEN + f"Web: Deleted document '{filename}' and its vectors.")
+        return jsonify({"status": "success"})
+    except Exception as e:
+        print(Fore.RED + f"Web: An error occurred while deleting '{filename}': {e}")
+        return jsonify({"status": "error", "message": "An internal error occurred."}), 500
 @app.route('/api/history/delete_all', methods=['POST'])
 def api_history_delete_all():
     try:
-        qdrant_client.recreate_collection(collection_name=CHAT_HISTORY_COLLECTION_NAME, vectors_config=models.VectorParams(size=VECTOR_DIMENSION, distance=models.Distance.COSINE))
-        qdrant_client.recreate_collection(collection_name=KNOWLEDGE_BASE_COLLECTION_NAME, vectors_config=models.VectorParams(size=VECTOR_DIMENSION, distance=models.Distance.COSINE))
-        if os.path.exists(CHAT_HISTORY_RAW_DIR): shutil.rmtree(CHAT_HISTORY_RAW_DIR)
-        os.makedirs(PROCESSED_HISTORY_DIR, exist_ok=True)
-        os.makedirs(CHAT_HISTORY_RAW_DIR, exist_ok=True)
+        with pipeline_lock:
+            # Recreate the physical collections so any aliases pointing at them stay valid
+            vectors_config = models.VectorParams(size=index_state["vector_dimension"], distance=models.Distance.COSINE)
+            qdrant_client.recreate_collection(collection_name=resolve_collection_name(CHAT_HISTORY_COLLECTION_NAME), vectors_config=vectors_config)
+            qdrant_client.recreate_collection(collection_name=resolve_collection_name(KNOWLEDGE_BASE_COLLECTION_NAME), vectors_config=vectors_config)
+            for collection_name in (CHAT_HISTORY_COLLECTION_NAME, KNOWLEDGE_BASE_COLLECTION_NAME):
+                ensure_payload_indexes(qdrant_client, collection_name)
+                reset_manifest_collection(collection_name, {})
+                chunk_deduplicator.reset(collection_name)
+                lexical_index.reset(collection_name)
+            if os.path.exists(CHAT_HISTORY_RAW_DIR): shutil.rmtree(CHAT_HISTORY_RAW_DIR)
+            os.makedirs(PROCESSED_HISTORY_DIR, exist_ok=True)
+            os.makedirs(CHAT_HISTORY_RAW_DIR, exist_ok=True)
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"status": "error"}), 500
+@app.route('/api/admin/reindex', methods=['GET', 'POST'])
+def api_admin_reindex():
+    if request.method == 'GET':
+        return jsonify({"status": "success", "reindex": reindex_status, "index": index_state})
+    data = request.get_json(silent=True) or {}
+    model_name = data.get('model_name', EMBEDDING_MODEL_NAME)
+    if model_name not in REINDEX_ALLOWED_MODELS:
+        return jsonify({"status": "error", "message": f"'model_name' must be one of: {', '.join(sorted(REINDEX_ALLOWED_MODELS))}."}), 400
+    if not reindex_lock.acquire(blocking=False):
+        return jsonify({"status": "error", "message": "A reindex is already running."}), 409
+    reindex_status.clear()
+    reindex_status.update({"state": "starting", "model": model_name, "started_at": datetime.now().isoformat()})
+    Thread(target=run_reindex_job, args=(model_name,), daemon=True).start()
+    return jsonify({"status": "success", "reindex": reindex_status}), 202
+@app.route('/api/admin/compact', methods=['GET', 'POST'])
+def api_admin_compact():
+    if request.method == 'POST':
+        if compaction_lock.locked():
+            return jsonify({"status": "error", "message": "Compaction is already running."}), 409
+        Thread(target=run_compaction, daemon=True).start()
+        return jsonify({"status": "success", "message": "Compaction started."}), 202
+    return jsonify({"status": "success", "compaction": compaction_status})
+@app.route('/api/admin/profile', methods=['GET', 'POST'])
+def api_admin_profile():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        chat_requests = data.get('chat_requests', 0)
+        filename = data.get('file')
+        if not isinstance(chat_requests, int) or chat_requests < 0:
+            return jsonify({"status": "error", "message": "'chat_requests' must be a non-negative integer."}), 400
+        with profile_state_lock:
+            profile_state["chat_requests"] += chat_requests
+            if filename: profile_state["files"].add(os.path.basename(filename))
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with profile_state_lock:
+        pending = {"chat_requests": profile_state["chat_requests"], "files": sorted(profile_state["files"])}
+    return jsonify({"status": "success", "pending": pending, "profiles": sorted(os.listdir(PROFILE_DIR), reverse=True)})
+@app.route('/api/admin/profile/<path:name>', methods=['GET'])
+def api_admin_profile_download(name):
+    return send_from_directory(os.path.abspath(PROFILE_DIR), name, as_attachment=True)
+@app.route('/api/admin/dedup', methods=['GET'])
+def api_admin_dedup():
+    return jsonify({"status": "success", "collections": {name: chunk_deduplicator.stats(name) for name in DEDUP_COLLECTIONS}})
 @app.route('/api/settings', methods=['GET', 'POST'])
 def api_settings():
     config = load_config()
@@ -356,6 +1277,8 @@ def open_browser():
     webbrowser.open_new_tab('http://127.0.0.1:5000/')
 
 if __name__ == '__main__':
+    if not GEMINI_API_KEY:
+        raise ValueError("GEMINI_API_KEY not found in .env file.")
     # Start the background pipeline watcher only when running the main Flask process
     if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
         pipeline_thread = Thread(target=start_pipeline_watcher)
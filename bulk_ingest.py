@@ -0,0 +1,420 @@
+# bulk_ingest.py
+#
+# PURPOSE:
+# Offline bulk loader for large document backfills. Instead of dropping files into
+# `data/` one at a time and waiting for the watcher, this script takes a directory
+# (or a manifest file listing one path per line) and pushes every PDF / JSON chat
+# through the same chunking pipeline as app.py, using parallel stages:
+#
+#   extract (N worker processes)  ->  embed (batched across files)  ->  upsert (Qdrant)
+#
+# Extraction processes only import chunking.py, so they never load the embedding model;
+# app.py (Qdrant, the model, dedup and BM25 indexes) is imported by main() in this process.
+#
+# A checkpoint ledger (JSON Lines, file hash -> status) is appended after every file,
+# so a crashed or interrupted run can simply be started again: files whose hash is
+# already marked "done" are skipped. Source files are never moved or deleted; like the
+# watcher's, each ingested file is copied into data/Processed (or chat_history/Processed),
+# which reindexes, dependent re-ingests and deletes work from.
+#
+# HOW TO RUN:
+# Run this script from your terminal after the Qdrant container is running.
+# `python bulk_ingest.py path/to/pdfs --workers 4`
+# `python bulk_ingest.py --manifest files.txt --snapshot`
+
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import argparse
+import threading
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from colorama import init, Fore, Style
+init(autoreset=True)
+
+import chunking
+
+pixel = None # The app module, imported by main(); worker processes re-import this file and must not load it
+
+DEFAULT_LEDGER_FILE = "ingest_checkpoint.jsonl"
+SUPPORTED_EXTENSIONS = ('.pdf', '.json')
+_STOP = object() # Sentinel passed down the stage queues when the previous stage is finished
+
+
+def collect_input_files(directory=None, manifest=None):
+    """Returns the sorted list of supported files from a directory tree and/or a manifest file."""
+    files = set()
+    if directory:
+        for root, _, names in os.walk(directory):
+            for name in names:
+                if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                    files.add(os.path.abspath(os.path.join(root, name)))
+    if manifest:
+        with open(manifest, 'r', encoding='utf-8') as f:
+            for line in f:
+                path = line.strip()
+                if path and not path.startswith('#') and path.lower().endswith(SUPPORTED_EXTENSIONS):
+                    files.add(os.path.abspath(path))
+    return sorted(files)
+
+def load_ledger(ledger_file):
+    """Reads the checkpoint ledger. The last entry recorded for a file hash wins."""
+    ledger = {}
+    if not os.path.exists(ledger_file):
+        return ledger
+    with open(ledger_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue # A torn last line from a crash is ignored
+            ledger[entry['hash']] = entry
+    return ledger
+
+def get_processed_path(path):
+    """Returns where the copy of an ingested file lives, next to the files the watcher processed."""
+    processed_dir = chunking.PROCESSED_PDF_DIR if path.lower().endswith('.pdf') else chunking.PROCESSED_HISTORY_DIR
+    return os.path.abspath(os.path.join(processed_dir, os.path.basename(path)))
+
+def copy_to_processed(path, file_hash):
+    """Copies an ingested file into its Processed folder; a temporary name keeps half-copied files out of reindexes."""
+    processed_path = get_processed_path(path)
+    if processed_path == path:
+        return
+    if path.lower().endswith('.pdf'):
+        chunking.discard_replaced_artifact(processed_path, file_hash)
+    os.makedirs(os.path.dirname(processed_path), exist_ok=True)
+    temp_path = processed_path + ".tmp"
+    shutil.copy2(path, temp_path)
+    os.replace(temp_path, processed_path)
+
+def find_name_conflicts(jobs, ledger):
+    """
+    Returns {path: reason} for files that cannot be ingested because their base name, which keys
+    their points, manifest entry and Processed copy, is already used by a different file.
+    """
+    owners = {os.path.basename(entry['path']): entry['path'] for entry in ledger.values() if entry['status'] == "done"}
+    file_hashes = dict(jobs)
+    paths_by_name = {}
+    for path, _ in jobs:
+        paths_by_name.setdefault(os.path.basename(path), []).append(path)
+    conflicts = {}
+    for name, paths in paths_by_name.items():
+        if len(paths) > 1:
+            conflicts.update((path, f"base name '{name}' is shared by {len(paths)} input files; rename them") for path in paths)
+        elif owners.get(name, paths[0]) != paths[0]:
+            conflicts[paths[0]] = f"base name '{name}' was already ingested from '{owners[name]}'; rename one of them"
+        elif name not in owners and os.path.exists(get_processed_path(paths[0])):
+            processed_path = get_processed_path(paths[0])
+            if processed_path != paths[0] and chunking.file_sha256(processed_path) != file_hashes[paths[0]]:
+                conflicts[paths[0]] = f"a different '{name}' is already in '{os.path.dirname(processed_path)}'; rename one of them"
+    return conflicts
+
+class LedgerWriter:
+    """Appends checkpoint entries to the ledger file, flushing each one to disk."""
+    def __init__(self, ledger_file):
+        self._lock = threading.Lock()
+        self._file = open(ledger_file, 'a', encoding='utf-8')
+
+    def record(self, file_hash, path, status, chunks=0, error=None):
+        entry = {"hash": file_hash, "path": path, "status": status, "chunks": chunks,
+                 "error": error, "timestamp": datetime.now().isoformat()}
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class BulkIngestor:
+    """Runs the extract -> embed -> upsert stages and keeps per-run statistics."""
+    def __init__(self, ledger_writer, workers=4, embed_batch_size=256, queue_size=64):
+        self.ledger = ledger_writer
+        self.workers = workers
+        self.embed_batch_size = embed_batch_size
+        self.extracted = queue.Queue(maxsize=queue_size)
+        self.embedded = queue.Queue(maxsize=queue_size)
+        self.stats = {"done": 0, "failed": 0, "empty": 0, "chunks": 0, "duplicates": 0}
+        self.failures = []
+        self._stats_lock = threading.Lock()
+        self._stopping = threading.Event() # Set on Ctrl-C; queued files are dropped and redone by the next run
+        self.dependents = set() # (collection, source_file) of files whose skipped duplicates lost their original
+
+    def _fail(self, file_hash, path, error):
+        print(Fore.RED + f"Bulk: FAILED '{path}': {error}")
+        self.ledger.record(file_hash, path, "failed", error=str(error))
+        with self._stats_lock:
+            self.stats["failed"] += 1
+            self.failures.append((path, str(error)))
+
+    def _put(self, target_queue, item):
+        """Puts an item on a stage queue, giving up once the run is stopping. Returns whether it was queued."""
+        while not self._stopping.is_set():
+            try:
+                target_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _forget_dedup(self, path, collection_name):
+        """Drops a file's chunks from the dedup index when they will not reach Qdrant after all."""
+        if collection_name in pixel.DEDUP_COLLECTIONS:
+            pixel.forget_dedup_source(collection_name, os.path.basename(path), self.dependents)
+
+    def _extract_all(self, pool, jobs):
+        """Feeds files to the extraction processes, keeping only a few per worker in flight so memory stays bounded."""
+        jobs = iter(jobs)
+        in_flight = {}
+        while True:
+            while len(in_flight) < 2 * self.workers:
+                job = next(jobs, None)
+                if job is None: break
+                in_flight[pool.submit(chunking.load_chunks_for_file, *job)] = job
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, file_hash = in_flight.pop(future)
+                self._extracted(path, file_hash, future)
+
+    def _extracted(self, path, file_hash, future):
+        """Hands an extracted file to the embed stage. A Ctrl-C raised in the worker is re-raised here."""
+        try:
+            chunks, collection_name = future.result()
+        except Exception as e:
+            self._fail(file_hash, path, e)
+            return
+        if not chunks:
+            try:
+                copy_to_processed(path, file_hash)
+            except OSError as e:
+                self._fail(file_hash, path, e)
+                return
+            self.ledger.record(file_hash, path, "empty")
+            with self._stats_lock:
+                self.stats["empty"] += 1
+            return
+        self._put(self.extracted, (path, file_hash, chunks, collection_name))
+
+    def _embed_stage(self):
+        """
+        Deduplicates files as they arrive and embeds them together, so small files still fill
+        embed_batch_size. A batch is flushed once it is full or nothing more is waiting.
+        """
+        batch = [] # (path, file_hash, chunks, collection_name) of deduplicated files not yet embedded
+        while True:
+            try:
+                item = self.extracted.get_nowait() if batch else self.extracted.get()
+            except queue.Empty:
+                self._embed_batch(batch)
+                batch = []
+                continue
+            if item is _STOP:
+                self._embed_batch(batch)
+                self.embedded.put(_STOP)
+                return
+            path, file_hash, chunks, collection_name = item
+            if self._stopping.is_set():
+                continue
+            try:
+                # Dedup runs in this single stage thread so files are compared in a consistent order
+                total_chunks = len(chunks)
+                chunks = pixel.deduplicate_chunks(chunks, collection_name, os.path.basename(path), self.dependents)
+                with self._stats_lock:
+                    self.stats["duplicates"] += total_chunks - len(chunks)
+            except Exception as e:
+                self._forget_dedup(path, collection_name)
+                self._fail(file_hash, path, e)
+                continue
+            batch.append((path, file_hash, chunks, collection_name))
+            if sum(len(entry[2]) for entry in batch) >= self.embed_batch_size:
+                self._embed_batch(batch)
+                batch = []
+
+    def _embed_batch(self, batch):
+        """Embeds the chunks of several files in embed_batch_size calls and passes each file on to the upsert stage."""
+        if not batch:
+            return
+        all_chunks = [chunk for _, _, chunks, _ in batch for chunk in chunks]
+        vectors = []
+        try:
+            for start in range(0, len(all_chunks), self.embed_batch_size):
+                if self._stopping.is_set(): break
+                vectors.extend(pixel.embed_chunks(all_chunks[start:start + self.embed_batch_size]))
+        except Exception as e:
+            for path, file_hash, _, collection_name in batch:
+                self._forget_dedup(path, collection_name)
+                self._fail(file_hash, path, e)
+            return
+        offset = 0
+        for path, file_hash, chunks, collection_name in batch:
+            file_vectors = vectors[offset:offset + len(chunks)]
+            offset += len(chunks)
+            if len(file_vectors) < len(chunks) or not self._put(self.embedded, (path, file_hash, chunks, file_vectors, collection_name)):
+                self._forget_dedup(path, collection_name)
+
+    def _upsert_stage(self):
+        while True:
+            item = self.embedded.get()
+            if item is _STOP:
+                return
+            path, file_hash, chunks, vectors, collection_name = item
+            if self._stopping.is_set():
+                self._forget_dedup(path, collection_name)
+                continue
+            try:
+                point_ids = pixel.upsert_chunks(chunks, vectors, collection_name)
+                pixel.replace_source_points(collection_name, os.path.basename(path), point_ids)
+                pixel.index_lexical_chunks(collection_name, os.path.basename(path), chunks, point_ids)
+                copy_to_processed(path, file_hash)
+                self.ledger.record(file_hash, path, "done", chunks=len(chunks))
+                with self._stats_lock:
+                    self.stats["done"] += 1
+                    self.stats["chunks"] += len(chunks)
+                print(Fore.GREEN + f"Bulk: Ingested '{os.path.basename(path)}' ({len(chunks)} chunks).")
+            except Exception as e:
+                self._forget_dedup(path, collection_name)
+                self._fail(file_hash, path, e)
+
+    def run(self, jobs):
+        """
+        Processes a list of (path, file_hash) pairs through all three stages.
+        On Ctrl-C, queued files are dropped, the extraction processes are interrupted along with
+        this one, files past extraction finish their current step, and KeyboardInterrupt is
+        re-raised only once every stage thread has stopped.
+        """
+        embed_thread = threading.Thread(target=self._embed_stage, daemon=True)
+        upsert_thread = threading.Thread(target=self._upsert_stage, daemon=True)
+        embed_thread.start()
+        upsert_thread.start()
+        # Spawned, not forked: the workers start clean instead of copying the loaded model and stage threads
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            self._extract_all(pool, jobs)
+            pool.shutdown(wait=True)
+        except KeyboardInterrupt:
+            self._stopping.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            pool.shutdown(wait=True)
+            self.extracted.put(_STOP)
+            embed_thread.join()
+            upsert_thread.join()
+        self.reindex_dependents()
+
+    def reindex_dependents(self):
+        """
+        Re-ingests, in this process, the files whose chunks were skipped as duplicates of a file
+        that then failed or changed. They are in the Processed folders by now, even if they were
+        part of this run.
+        """
+        while self.dependents:
+            collection_name, source_file = self.dependents.pop()
+            pixel.reindex_dependent_sources(collection_name, [source_file], self.dependents)
+
+
+def print_report(stats, failures, skipped, elapsed):
+    """Prints the end-of-run throughput and failure report."""
+    processed = stats["done"] + stats["failed"] + stats["empty"]
+    print(Style.BRIGHT + Fore.MAGENTA + "\n--- Bulk Ingest Report ---")
+    print(f"Files ingested:         {stats['done']}")
+    print(f"Files empty:            {stats['empty']}")
+    print(f"Files failed:           {stats['failed']}")
+    print(f"Files skipped (ledger): {skipped}")
+    print(f"Chunks upserted:        {stats['chunks']}")
+    total_chunks = stats['chunks'] + stats['duplicates']
+    print(f"Duplicate chunks:       {stats['duplicates']} ({stats['duplicates'] / total_chunks if total_chunks else 0:.1%} of extracted)")
+    print(f"Elapsed:                {elapsed:.1f}s")
+    if elapsed > 0:
+        print(f"Throughput:             {processed / elapsed:.2f} files/s, {stats['chunks'] / elapsed:.1f} chunks/s")
+    if failures:
+        print(Fore.RED + "\nFailures:")
+        for path, error in failures:
+            print(Fore.RED + f"  {path}: {error}")
+
+def create_snapshots():
+    """Creates a Qdrant snapshot of both collections after the backfill."""
+    for collection_name in (chunking.KNOWLEDGE_BASE_COLLECTION_NAME, chunking.CHAT_HISTORY_COLLECTION_NAME):
+        try:
+            snapshot = pixel.qdrant_client.create_snapshot(collection_name=pixel.resolve_collection_name(collection_name), wait=True)
+            print(Fore.GREEN + f"Bulk: Snapshot of '{collection_name}' created: {snapshot.name}")
+        except Exception as e:
+            print(Fore.RED + f"Bulk: Could not snapshot '{collection_name}': {e}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-ingest PDFs and chat histories into Qdrant.")
+    parser.add_argument("directory", nargs="?", help="Directory to scan (recursively) for .pdf/.json files.")
+    parser.add_argument("--manifest", help="Text file listing one file path per line.")
+    parser.add_argument("--ledger", default=DEFAULT_LEDGER_FILE, help="Checkpoint ledger file (default: %(default)s).")
+    parser.add_argument("--workers", type=int, default=4, help="Parallel extraction processes (default: %(default)s).")
+    parser.add_argument("--embed-batch-size", type=int, default=256, help="Chunks per embedding call (default: %(default)s).")
+    parser.add_argument("--retry-failed", action="store_true", help="Also retry files marked as failed in the ledger.")
+    parser.add_argument("--snapshot", action="store_true", help="Create a Qdrant snapshot of both collections at the end.")
+    args = parser.parse_args(argv)
+
+    if not args.directory and not args.manifest:
+        parser.error("Provide a directory and/or --manifest.")
+
+    global pixel
+    import app as pixel
+
+    if not pixel.ensure_collection_exists(pixel.qdrant_client, chunking.KNOWLEDGE_BASE_COLLECTION_NAME, pixel.index_state["vector_dimension"]): return 1
+    if not pixel.ensure_collection_exists(pixel.qdrant_client, chunking.CHAT_HISTORY_COLLECTION_NAME, pixel.index_state["vector_dimension"]): return 1
+
+    files = collect_input_files(args.directory, args.manifest)
+    print(Fore.CYAN + f"Bulk: Found {len(files)} candidate file(s).")
+
+    ledger = load_ledger(args.ledger)
+    skip_statuses = {"done", "empty"} if args.retry_failed else {"done", "empty", "failed"}
+    jobs, skipped, seen_hashes = [], 0, set()
+    for path in files:
+        try:
+            file_hash = chunking.file_sha256(path)
+        except OSError as e:
+            print(Fore.RED + f"Bulk: Cannot read '{path}': {e}")
+            continue
+        if file_hash in seen_hashes or ledger.get(file_hash, {}).get("status") in skip_statuses:
+            skipped += 1
+            continue
+        seen_hashes.add(file_hash)
+        jobs.append((path, file_hash))
+    print(Fore.CYAN + f"Bulk: {len(jobs)} file(s) to ingest, {skipped} skipped by the checkpoint ledger.")
+
+    writer = LedgerWriter(args.ledger)
+    ingestor = BulkIngestor(writer, workers=args.workers, embed_batch_size=args.embed_batch_size)
+    # Conflicting files are reported but not written to the ledger, so they are retried once renamed
+    conflicts = find_name_conflicts(jobs, ledger)
+    for path, reason in conflicts.items():
+        print(Fore.RED + f"Bulk: FAILED '{path}': {reason}")
+        ingestor.stats["failed"] += 1
+        ingestor.failures.append((path, reason))
+    jobs = [(path, file_hash) for path, file_hash in jobs if path not in conflicts]
+    start_time = time.time()
+    try:
+        ingestor.run(jobs)
+    except KeyboardInterrupt:
+        print(Fore.YELLOW + "\nBulk: Interrupted. Completed files are recorded; re-run to resume.")
+        if ingestor.dependents:
+            pending = ", ".join(sorted(source_file for _, source_file in ingestor.dependents))
+            print(Fore.YELLOW + f"Bulk: These files lost the original of chunks they skipped as duplicates; move them from data/Processed back into data/ to re-ingest: {pending}")
+    finally:
+        writer.close()
+
+    print_report(ingestor.stats, ingestor.failures, skipped, time.time() - start_time)
+    if args.snapshot:
+        create_snapshots()
+    return 1 if ingestor.stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
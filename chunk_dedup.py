@@ -0,0 +1,180 @@
+# chunk_dedup.py
+#
+# PURPOSE:
+# Near-duplicate chunk detection for the ingestion pipeline. Each chunk is reduced to a
+# MinHash signature over word shingles, and an LSH (banding) index of those signatures is
+# kept in a small SQLite file across runs. Before a file's chunks are embedded, any chunk
+# that is a near-duplicate of a chunk already indexed from *another* source (or an earlier
+# chunk of the same file) is skipped, and a cross-reference to the chunk it duplicates is
+# recorded instead.
+
+import re
+import zlib
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+_MAX_HASH = np.uint64(4294967291) # Largest prime below 2**32; keeps a*x+b inside uint64
+
+
+class ChunkDeduplicator:
+    """Persistent MinHash/LSH index of chunk signatures, keyed by (collection, source_file, chunk_index)."""
+    def __init__(self, db_path, threshold=0.85, num_perm=128, bands=16, shingle_size=5, min_words=20):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands.")
+        self.db_path = db_path
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.min_words = min_words
+        # Fixed seed: signatures are persisted, so the permutations must be identical across runs
+        generator = np.random.RandomState(1)
+        self._perm_a = generator.randint(1, int(_MAX_HASH), size=num_perm, dtype=np.uint64)
+        self._perm_b = generator.randint(0, int(_MAX_HASH), size=num_perm, dtype=np.uint64)
+        self._lock = threading.Lock()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS signatures (collection TEXT, source_file TEXT, chunk_index INTEGER, signature BLOB, PRIMARY KEY (collection, source_file, chunk_index))")
+                conn.execute("CREATE TABLE IF NOT EXISTS buckets (collection TEXT, band INTEGER, bucket INTEGER, source_file TEXT, chunk_index INTEGER)")
+                conn.execute("CREATE INDEX IF NOT EXISTS buckets_lookup ON buckets (collection, band, bucket)")
+                conn.execute("CREATE INDEX IF NOT EXISTS buckets_source ON buckets (collection, source_file)")
+                conn.execute("CREATE TABLE IF NOT EXISTS duplicates (collection TEXT, source_file TEXT, chunk_index INTEGER, original_source TEXT, original_chunk_index INTEGER)")
+                conn.execute("CREATE INDEX IF NOT EXISTS duplicates_source ON duplicates (collection, source_file)")
+                conn.execute("CREATE INDEX IF NOT EXISTS duplicates_original ON duplicates (collection, original_source)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def signature(self, text):
+        """Returns the MinHash signature of a text, or None if it is too short to compare reliably."""
+        words = re.findall(r'\w+', text.lower())
+        if len(words) < self.min_words:
+            return None
+        shingles = {" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        permuted = (np.outer(self._perm_a, hashes) + self._perm_b[:, None]) % _MAX_HASH
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def _band_buckets(self, signature):
+        for band in range(self.bands):
+            digest = hashlib.blake2b(signature[band * self.rows:(band + 1) * self.rows].tobytes(), digest_size=8).digest()
+            yield band, int.from_bytes(digest, 'big', signed=True)
+
+    def _find_original(self, conn, collection_name, source_file, signature, buckets, local_buckets):
+        """Returns the (source_file, chunk_index) of an indexed near-duplicate, or None."""
+        candidates = {}
+        for key in buckets:
+            for chunk_index, candidate_signature in local_buckets.get(key, ()):
+                candidates[(source_file, chunk_index)] = candidate_signature
+        placeholders = ",".join("(?, ?)" for _ in buckets)
+        rows = conn.execute(
+            f"SELECT DISTINCT b.source_file, b.chunk_index, s.signature FROM buckets b "
+            f"JOIN signatures s ON s.collection = b.collection AND s.source_file = b.source_file AND s.chunk_index = b.chunk_index "
+            f"WHERE b.collection = ? AND b.source_file != ? AND (b.band, b.bucket) IN (VALUES {placeholders})",
+            [collection_name, source_file] + [value for key in buckets for value in key],
+        ).fetchall()
+        for candidate_source, candidate_index, blob in rows:
+            candidates[(candidate_source, candidate_index)] = np.frombuffer(blob, dtype=np.uint32)
+        best, best_similarity = None, self.threshold
+        for key, candidate_signature in candidates.items():
+            similarity = float(np.mean(candidate_signature == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = key, similarity
+        return best
+
+    def deduplicate(self, collection_name, source_file, chunks):
+        """
+        Filters near-duplicate chunks out of a source file's chunks and records the kept ones
+        in the index, replacing anything previously indexed for that source.
+        Chunks must carry 'chunk_index' metadata. Returns (kept_chunks, duplicate_count, orphaned_sources),
+        where orphaned_sources are other files whose skipped chunks pointed at a chunk this source no
+        longer keeps; they must be re-ingested or that content is no longer searchable.
+        """
+        with self._lock:
+            conn = self._connect()
+            try:
+                kept, signature_rows, bucket_rows, duplicate_rows = [], [], [], []
+                local_buckets = {}
+                for chunk in chunks:
+                    chunk_index = chunk.metadata['chunk_index']
+                    signature = self.signature(chunk.page_content)
+                    if signature is None:
+                        kept.append(chunk)
+                        continue
+                    buckets = list(self._band_buckets(signature))
+                    original = self._find_original(conn, collection_name, source_file, signature, buckets, local_buckets)
+                    if original:
+                        duplicate_rows.append((collection_name, source_file, chunk_index) + original)
+                        continue
+                    kept.append(chunk)
+                    signature_rows.append((collection_name, source_file, chunk_index, signature.tobytes()))
+                    for band, bucket in buckets:
+                        bucket_rows.append((collection_name, band, bucket, source_file, chunk_index))
+                        local_buckets.setdefault((band, bucket), []).append((chunk_index, signature))
+                # A dependent is orphaned if the chunk it duplicated is gone or its content changed
+                new_signatures = {row[2]: row[3] for row in signature_rows}
+                old_signatures = dict(conn.execute(
+                    "SELECT chunk_index, signature FROM signatures WHERE collection = ? AND source_file = ?", (collection_name, source_file),
+                ).fetchall())
+                orphaned_sources = sorted({dependent for dependent, original_index in conn.execute(
+                    "SELECT source_file, original_chunk_index FROM duplicates WHERE collection = ? AND original_source = ? AND source_file != ?",
+                    (collection_name, source_file, source_file),
+                ) if new_signatures.get(original_index) != old_signatures.get(original_index)})
+                with conn:
+                    self._delete_source(conn, collection_name, source_file)
+                    conn.executemany("INSERT INTO signatures VALUES (?, ?, ?, ?)", signature_rows)
+                    conn.executemany("INSERT INTO buckets VALUES (?, ?, ?, ?, ?)", bucket_rows)
+                    conn.executemany("INSERT INTO duplicates VALUES (?, ?, ?, ?, ?)", duplicate_rows)
+            finally:
+                conn.close()
+        return kept, len(duplicate_rows), orphaned_sources
+
+    def _delete_source(self, conn, collection_name, source_file):
+        for table in ("signatures", "buckets", "duplicates"):
+            conn.execute(f"DELETE FROM {table} WHERE collection = ? AND source_file = ?", (collection_name, source_file))
+
+    def forget_source(self, collection_name, source_file):
+        """
+        Removes a source from the index. Returns the other source files that had chunks skipped
+        as duplicates of it; they must be re-ingested or that content is no longer searchable.
+        """
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    dependents = [row[0] for row in conn.execute(
+                        "SELECT DISTINCT source_file FROM duplicates WHERE collection = ? AND original_source = ? AND source_file != ?",
+                        (collection_name, source_file, source_file),
+                    )]
+                    self._delete_source(conn, collection_name, source_file)
+            finally:
+                conn.close()
+        return dependents
+
+    def reset(self, collection_name):
+        """Forgets every source of a collection."""
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    for table in ("signatures", "buckets", "duplicates"):
+                        conn.execute(f"DELETE FROM {table} WHERE collection = ?", (collection_name,))
+            finally:
+                conn.close()
+
+    def stats(self, collection_name):
+        """Returns indexed/duplicate chunk counts and the overall dedup ratio for a collection."""
+        conn = self._connect()
+        try:
+            indexed = conn.execute("SELECT COUNT(*) FROM signatures WHERE collection = ?", (collection_name,)).fetchone()[0]
+            duplicates = conn.execute("SELECT COUNT(*) FROM duplicates WHERE collection = ?", (collection_name,)).fetchone()[0]
+        finally:
+            conn.close()
+        total = indexed + duplicates
+        return {"indexed_chunks": indexed, "duplicate_chunks": duplicates, "dedup_ratio": duplicates / total if total else 0.0}
@@ -0,0 +1,207 @@
+# chunking.py
+#
+# PURPOSE:
+# Turns a PDF or a JSON chat history into the text chunks that get embedded. This is
+# shared by app.py (watcher, reindexes) and bulk_ingest.py (extraction processes), so it
+# must stay free of import-time side effects: no model, client or API key is touched here.
+
+import os
+import json
+import gzip
+import bisect
+import hashlib
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.documents import Document
+from pypdf import PdfReader
+from colorama import Fore
+
+from process_pdfs import _analyze_outline_levels, _get_outlines_at_specified_level
+
+# --- File Locations ---
+CHAT_HISTORY_RAW_DIR = "chat_history"
+PROCESSED_HISTORY_DIR = os.path.join(CHAT_HISTORY_RAW_DIR, "Processed")
+DATA_DIR = "data"
+PROCESSED_PDF_DIR = os.path.join(DATA_DIR, "Processed")
+ARTIFACT_DIR = os.path.join(PROCESSED_PDF_DIR, "artifacts") # Extracted page text + chunk boundaries, keyed by PDF hash
+
+# --- Chunking Configuration ---
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+# Retrievers and the pipeline always use these names. After the first reindex they are
+# Qdrant aliases pointing at versioned collections (e.g. 'knowledge_base_v2').
+KNOWLEDGE_BASE_COLLECTION_NAME = "knowledge_base"
+CHAT_HISTORY_COLLECTION_NAME = "chat_history_db"
+
+
+def file_sha256(file_path: str) -> str:
+    """Returns the SHA-256 hex digest of a file's contents, read in 1 MB blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_chapter_page_starts(file_path: str):
+    """Returns [(first_page_index, chapter_title), ...] from a PDF's outline, or [] if it has none."""
+    try:
+        reader = PdfReader(file_path)
+        outlines = reader.outline
+        if not outlines:
+            return []
+        levels_info = _analyze_outline_levels(outlines)
+        # A lone root entry is usually the book title; use the first level with several entries
+        chapter_level = next((level for level in sorted(levels_info) if levels_info[level]['count'] > 1), min(levels_info))
+        starts = []
+        for outline in _get_outlines_at_specified_level(outlines, chapter_level):
+            try:
+                page_index = reader.get_page_number(outline.page)
+            except Exception:
+                continue
+            if page_index is not None:
+                starts.append((page_index, outline.title.strip()))
+        return sorted(starts)
+    except Exception as e:
+        print(Fore.YELLOW + f"Pipeline: Could not read the outline of '{os.path.basename(file_path)}': {e}")
+        return []
+
+def get_page_metadata(book: str, page_index: int, chapter_starts):
+    """Builds the book/chapter/page payload for a chunk. 'page' is 1-based; front matter has no chapter."""
+    metadata = {"book": book, "page": page_index + 1}
+    position = bisect.bisect_right([start for start, _ in chapter_starts], page_index) - 1
+    if position >= 0:
+        metadata["chapter"] = chapter_starts[position][1]
+    return metadata
+
+# --- Extracted-Text Artifacts ---
+# Parsing PDFs is the slowest part of ingestion, so the extracted page texts, outline and
+# chunk boundaries are saved as gzipped JSON Lines in ARTIFACT_DIR/<sha256>.jsonl.gz.
+# Re-chunking, re-embedding and reindexing read these instead of parsing the PDF again.
+#
+#   {"type": "header", "file": ..., "chapter_starts": [[page, title], ...], "chunk_size": ..., "chunk_overlap": ...}
+#   {"type": "page", "page": 0, "text": "..."}               (one line per page)
+#   {"type": "chunk", "page": 0, "start": 0, "end": 998}     (one line per chunk; omitted if boundaries are unknown)
+
+def get_artifact_path(file_hash: str) -> str:
+    return os.path.join(ARTIFACT_DIR, f"{file_hash}.jsonl.gz")
+
+def read_text_artifact(file_hash: str):
+    """Streams an artifact back into (header, pages, chunk_boundaries), or returns None if there is none."""
+    artifact_path = get_artifact_path(file_hash)
+    if not os.path.exists(artifact_path):
+        return None
+    header, pages, chunk_boundaries = None, {}, []
+    try:
+        with gzip.open(artifact_path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                if record["type"] == "header": header = record
+                elif record["type"] == "page": pages[record["page"]] = record["text"]
+                elif record["type"] == "chunk": chunk_boundaries.append((record["page"], record["start"], record["end"]))
+    except (OSError, EOFError, ValueError, KeyError) as e:
+        print(Fore.YELLOW + f"Pipeline: Ignoring unreadable artifact '{artifact_path}': {e}")
+        return None
+    return (header, pages, chunk_boundaries) if header else None
+
+def write_text_artifact(file_hash: str, filename: str, pages: dict, chapter_starts, chunk_boundaries):
+    """Writes an artifact atomically, so a crash never leaves a truncated one behind."""
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    artifact_path = get_artifact_path(file_hash)
+    temp_path = artifact_path + ".tmp"
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+        header = {"type": "header", "file": filename, "chapter_starts": chapter_starts, "chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP}
+        f.write(json.dumps(header) + "\n")
+        for page_index in sorted(pages):
+            f.write(json.dumps({"type": "page", "page": page_index, "text": pages[page_index]}) + "\n")
+        for page_index, start, end in chunk_boundaries or ():
+            f.write(json.dumps({"type": "chunk", "page": page_index, "start": start, "end": end}) + "\n")
+    os.replace(temp_path, artifact_path)
+
+def _split_pages(pages: dict):
+    """Chunks page texts and returns (chunks, boundaries); boundaries is None if they cannot be located."""
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, add_start_index=True)
+    page_documents = [Document(page_content=pages[page_index], metadata={"page": page_index}) for page_index in sorted(pages)]
+    chunks = text_splitter.split_documents(page_documents)
+    boundaries = []
+    for chunk in chunks:
+        start = chunk.metadata.get("start_index", -1)
+        if start < 0:
+            return chunks, None
+        boundaries.append((chunk.metadata["page"], start, start + len(chunk.page_content)))
+    return chunks, boundaries
+
+def load_pdf_chunks(file_path: str, file_hash=None):
+    """
+    Returns (chunks, chapter_starts) for a PDF, preferring its extracted-text artifact.
+    The PDF is only parsed when no artifact exists for its hash.
+    """
+    file_hash = file_hash or file_sha256(file_path)
+    artifact = read_text_artifact(file_hash)
+    if artifact:
+        header, pages, chunk_boundaries = artifact
+        chapter_starts = [tuple(start) for start in header["chapter_starts"]]
+        if chunk_boundaries and header["chunk_size"] == CHUNK_SIZE and header["chunk_overlap"] == CHUNK_OVERLAP:
+            chunks = [Document(page_content=pages[page_index][start:end], metadata={"page": page_index}) for page_index, start, end in chunk_boundaries]
+            return chunks, chapter_starts
+        # Chunking settings changed: re-split the stored text and remember the new boundaries
+        chunks, chunk_boundaries = _split_pages(pages)
+        try:
+            write_text_artifact(file_hash, os.path.basename(file_path), pages, chapter_starts, chunk_boundaries)
+        except OSError as e:
+            print(Fore.YELLOW + f"Pipeline: Could not update text artifact for '{os.path.basename(file_path)}': {e}")
+        return chunks, chapter_starts
+
+    documents = PyPDFLoader(file_path).load()
+    pages = {document.metadata.get("page", page_index): document.page_content for page_index, document in enumerate(documents)}
+    chapter_starts = get_chapter_page_starts(file_path)
+    chunks, chunk_boundaries = _split_pages(pages)
+    try:
+        write_text_artifact(file_hash, os.path.basename(file_path), pages, chapter_starts, chunk_boundaries)
+    except OSError as e:
+        print(Fore.YELLOW + f"Pipeline: Could not save text artifact for '{os.path.basename(file_path)}': {e}")
+    return chunks, chapter_starts
+
+def discard_replaced_artifact(processed_path: str, new_hash: str):
+    """Deletes the artifact of a processed PDF that a different file of the same name is about to replace."""
+    if not os.path.exists(processed_path): return
+    old_hash = file_sha256(processed_path)
+    if old_hash != new_hash and os.path.exists(get_artifact_path(old_hash)):
+        os.remove(get_artifact_path(old_hash))
+
+def load_chunks_for_file(file_path: str, file_hash=None):
+    """
+    Extracts and chunks a single file (PDF or JSON chat history).
+    Returns (chunks, collection_name); every chunk carries the 'source_file' metadata,
+    and PDF chunks also carry 'book', 'chapter' and 'page'.
+    """
+    filename = os.path.basename(file_path)
+    is_pdf = filename.lower().endswith('.pdf')
+    collection_name = KNOWLEDGE_BASE_COLLECTION_NAME if is_pdf else CHAT_HISTORY_COLLECTION_NAME
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    base_metadata = {"source_file": filename}
+
+    if is_pdf:
+        chunks, chapter_starts = load_pdf_chunks(file_path, file_hash)
+        book = os.path.splitext(filename)[0]
+        chunk_metadata = [get_page_metadata(book, chunk.metadata.get("page", 0), chapter_starts) for chunk in chunks]
+    else: # It's a JSON chat history
+        with open(file_path, 'r', encoding='utf-8') as f:
+            chat_data = json.load(f)
+        if not chat_data.get('history'):
+            return [], collection_name
+        if chat_data.get('memory'):
+            # Compacted conversation: only its summary memory is indexed
+            transcript = f"Chat Summary: {chat_data.get('summary', 'Untitled')}\n\nMemory: {chat_data['memory']}"
+            base_metadata["compacted"] = True
+        else:
+            transcript = f"Chat Summary: {chat_data.get('summary', 'Untitled')}\n\n" + "\n".join(
+                [f"{item['role']}: {item['content']}" for item in chat_data.get('history', [])]
+            )
+        chunks = text_splitter.create_documents([transcript])
+        chunk_metadata = [{} for _ in chunks]
+
+    for chunk_index, (chunk, extra_metadata) in enumerate(zip(chunks, chunk_metadata)):
+        chunk.metadata = dict(base_metadata, **extra_metadata, chunk_index=chunk_index)
+    return chunks, collection_name
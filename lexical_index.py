@@ -0,0 +1,190 @@
+# lexical_index.py
+#
+# PURPOSE:
+# A local BM25 inverted index over the same chunks that are embedded into Qdrant, stored in
+# a small SQLite file and keyed by the chunks' Qdrant point IDs. It lets app.py find exact
+# identifiers (error codes, function names, chapter titles) that dense search misses, fuse
+# lexical and dense rankings, and answer short keyword queries without running the
+# embedding model at all.
+
+import re
+import math
+import sqlite3
+import threading
+from collections import Counter
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Lowercased word tokens; underscores and digits are kept so identifiers stay whole."""
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def looks_like_identifier(word):
+    """True for words that name something exactly: snake_case, camelCase or ACRONYMS, and codes mixing letters and digits."""
+    has_letters = any(char.isalpha() for char in word)
+    return (
+        "_" in word.strip("_")
+        or (has_letters and any(char.isdigit() for char in word))
+        or (len(word) >= 3 and any(char.isupper() for char in word[1:]))
+    )
+
+
+def reciprocal_rank_fusion(rankings, limit, k=60):
+    """Fuses several best-first lists of IDs into one, scoring each ID by the sum of 1 / (k + rank)."""
+    scores = Counter()
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] += 1 / (k + rank)
+    return [item for item, _ in scores.most_common(limit)]
+
+
+class LexicalIndex:
+    """BM25 inverted index of chunks, partitioned by collection name."""
+    def __init__(self, db_path, k1=1.5, b=0.75, max_df_ratio=0.5):
+        self.db_path = db_path
+        self.k1 = k1
+        self.b = b
+        self.max_df_ratio = max_df_ratio # Terms in more than this share of chunks are ignored (stopwords)
+        self._lock = threading.Lock()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS docs (collection TEXT, point_id TEXT, source_file TEXT, book TEXT, chapter TEXT, length INTEGER, PRIMARY KEY (collection, point_id))")
+                conn.execute("CREATE INDEX IF NOT EXISTS docs_source ON docs (collection, source_file)")
+                conn.execute("CREATE TABLE IF NOT EXISTS postings (collection TEXT, term TEXT, point_id TEXT, tf INTEGER)")
+                conn.execute("CREATE INDEX IF NOT EXISTS postings_term ON postings (collection, term)")
+                conn.execute("CREATE INDEX IF NOT EXISTS postings_point ON postings (collection, point_id)")
+                conn.execute("CREATE TABLE IF NOT EXISTS stats (collection TEXT PRIMARY KEY, doc_count INTEGER, total_length INTEGER)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _adjust_stats(self, conn, collection_name, doc_delta, length_delta):
+        conn.execute("INSERT OR IGNORE INTO stats VALUES (?, 0, 0)", (collection_name,))
+        conn.execute("UPDATE stats SET doc_count = doc_count + ?, total_length = total_length + ? WHERE collection = ?", (doc_delta, length_delta, collection_name))
+
+    def _remove_source(self, conn, collection_name, source_file):
+        removed = conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs WHERE collection = ? AND source_file = ?", (collection_name, source_file)).fetchone()
+        conn.execute("DELETE FROM postings WHERE collection = ? AND point_id IN (SELECT point_id FROM docs WHERE collection = ? AND source_file = ?)", (collection_name, collection_name, source_file))
+        conn.execute("DELETE FROM docs WHERE collection = ? AND source_file = ?", (collection_name, source_file))
+        self._adjust_stats(conn, collection_name, -removed[0], -removed[1])
+
+    def _insert(self, conn, collection_name, entries):
+        total_length = 0
+        for point_id, text, metadata in entries:
+            term_counts = Counter(tokenize(text))
+            length = sum(term_counts.values())
+            total_length += length
+            conn.execute("INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?, ?)",
+                         (collection_name, point_id, metadata.get("source_file"), metadata.get("book"), metadata.get("chapter"), length))
+            conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)",
+                             [(collection_name, term, point_id, tf) for term, tf in term_counts.items()])
+        self._adjust_stats(conn, collection_name, len(entries), total_length)
+
+    def replace_source(self, collection_name, source_file, entries):
+        """Replaces everything indexed for a source with `entries`, a list of (point_id, text, metadata)."""
+        entries = [(point_id, text, dict(metadata, source_file=source_file)) for point_id, text, metadata in entries]
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    self._remove_source(conn, collection_name, source_file)
+                    self._insert(conn, collection_name, entries)
+            finally:
+                conn.close()
+
+    def add(self, collection_name, entries):
+        """Indexes (point_id, text, metadata) entries not indexed yet; each source is taken from metadata['source_file']."""
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    self._insert(conn, collection_name, entries)
+            finally:
+                conn.close()
+
+    def remove_source(self, collection_name, source_file):
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    self._remove_source(conn, collection_name, source_file)
+            finally:
+                conn.close()
+
+    def reset(self, collection_name):
+        """Forgets every chunk of a collection."""
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    for table in ("docs", "postings", "stats"):
+                        conn.execute(f"DELETE FROM {table} WHERE collection = ?", (collection_name,))
+            finally:
+                conn.close()
+
+    def rename_collection(self, old_name, new_name):
+        """Moves a fully built partition over to a new name, replacing whatever was there."""
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    for table in ("docs", "postings", "stats"):
+                        conn.execute(f"DELETE FROM {table} WHERE collection = ?", (new_name,))
+                        conn.execute(f"UPDATE {table} SET collection = ? WHERE collection = ?", (new_name, old_name))
+            finally:
+                conn.close()
+
+    def count(self, collection_name):
+        """Returns how many chunks of a collection are indexed."""
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT doc_count FROM stats WHERE collection = ?", (collection_name,)).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else 0
+
+    def search(self, collection_name, query, k=10, scope=None):
+        """Returns up to k (point_id, bm25_score) pairs, best first. `scope` may restrict 'book'/'chapter'."""
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT doc_count, total_length FROM stats WHERE collection = ?", (collection_name,)).fetchone()
+            if not row or not row[0]:
+                return []
+            doc_count, average_length = row[0], row[1] / row[0]
+            placeholders = ",".join("?" for _ in terms)
+            document_frequencies = dict(conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE collection = ? AND term IN ({placeholders}) GROUP BY term",
+                [collection_name] + terms,
+            ).fetchall())
+            idf = {
+                term: math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+                for term, df in document_frequencies.items() if df <= self.max_df_ratio * doc_count or doc_count < 10
+            }
+            if not idf:
+                return []
+            scope_sql, scope_params = "", []
+            for field in ("book", "chapter"):
+                if scope and scope.get(field):
+                    scope_sql += f" AND d.{field} = ?"
+                    scope_params.append(scope[field])
+            placeholders = ",".join("?" for _ in idf)
+            rows = conn.execute(
+                f"SELECT p.point_id, p.term, p.tf, d.length FROM postings p "
+                f"JOIN docs d ON d.collection = p.collection AND d.point_id = p.point_id "
+                f"WHERE p.collection = ? AND p.term IN ({placeholders}){scope_sql}",
+                [collection_name] + list(idf) + scope_params,
+            ).fetchall()
+        finally:
+            conn.close()
+        scores = Counter()
+        for point_id, term, tf, length in rows:
+            scores[point_id] += idf[term] * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / average_length))
+        return scores.most_common(k)
@@ -0,0 +1,82 @@
+import random
+from types import SimpleNamespace
+
+from chunk_dedup import ChunkDeduplicator
+
+KB = "knowledge_base"
+
+
+def make_text(seed, words=120):
+    generator = random.Random(seed)
+    return " ".join(f"word{generator.randint(0, 5000)}" for _ in range(words))
+
+def make_chunks(*texts):
+    return [SimpleNamespace(page_content=text, metadata={"chunk_index": index}) for index, text in enumerate(texts)]
+
+def make_deduplicator(tmp_path):
+    return ChunkDeduplicator(str(tmp_path / "dedup.db"))
+
+
+def test_near_duplicates_of_another_source_are_skipped(tmp_path):
+    dedup = make_deduplicator(tmp_path)
+    original, other = make_text(1), make_text(2)
+    kept, duplicates, orphaned = dedup.deduplicate(KB, "a.pdf", make_chunks(original, other))
+    assert len(kept) == 2 and duplicates == 0 and orphaned == []
+
+    # A different last word is still a near-duplicate; unrelated text is not
+    near_copy = original.rsplit(" ", 1)[0] + " changed"
+    kept, duplicates, orphaned = dedup.deduplicate(KB, "b.pdf", make_chunks(near_copy, make_text(3)))
+    assert [chunk.page_content for chunk in kept] == [make_text(3)]
+    assert duplicates == 1 and orphaned == []
+    assert dedup.stats(KB) == {"indexed_chunks": 3, "duplicate_chunks": 1, "dedup_ratio": 0.25}
+
+def test_repeated_chunks_within_one_source_are_skipped(tmp_path):
+    dedup = make_deduplicator(tmp_path)
+    text = make_text(1)
+    kept, duplicates, _ = dedup.deduplicate(KB, "a.pdf", make_chunks(text, text))
+    assert [chunk.metadata["chunk_index"] for chunk in kept] == [0]
+    assert duplicates == 1
+
+def test_short_chunks_are_always_kept(tmp_path):
+    dedup = make_deduplicator(tmp_path)
+    short = "too short to compare reliably"
+    dedup.deduplicate(KB, "a.pdf", make_chunks(short))
+    kept, duplicates, _ = dedup.deduplicate(KB, "b.pdf", make_chunks(short))
+    assert len(kept) == 1 and duplicates == 0
+
+def test_reingesting_a_source_replaces_its_entries(tmp_path):
+    dedup = make_deduplicator(tmp_path)
+    dedup.deduplicate(KB, "a.pdf", make_chunks(make_text(1), make_text(2)))
+    dedup.deduplicate(KB, "a.pdf", make_chunks(make_text(1), make_text(2)))
+    assert dedup.stats(KB)["indexed_chunks"] == 2
+
+def test_forget_source_returns_dependents_and_frees_the_content(tmp_path):
+    dedup = make_deduplicator(tmp_path)
+    text = make_text(1)
+    dedup.deduplicate(KB, "a.pdf", make_chunks(text))
+    dedup.deduplicate(KB, "b.pdf", make_chunks(text))
+    assert dedup.forget_source(KB, "a.pdf") == ["b.pdf"]
+    # With the original gone, the dependent's chunk is kept when it is re-ingested
+    kept, duplicates, _ = dedup.deduplicate(KB, "b.pdf", make_chunks(text))
+    assert len(kept) == 1 and duplicates == 0
+
+def test_changing_an_original_chunk_orphans_its_dependents(tmp_path):
+    dedup = make_deduplicator(tmp_path)
+    first, second = make_text(1), make_text(2)
+    dedup.deduplicate(KB, "a.pdf", make_chunks(first, second))
+    dedup.deduplicate(KB, "b.pdf", make_chunks(second))
+
+    # Unchanged content, or a change to a chunk nobody depends on, orphans nothing
+    assert dedup.deduplicate(KB, "a.pdf", make_chunks(first, second))[2] == []
+    assert dedup.deduplicate(KB, "a.pdf", make_chunks(make_text(3), second))[2] == []
+    # Replacing the chunk b.pdf skipped does
+    assert dedup.deduplicate(KB, "a.pdf", make_chunks(make_text(3), make_text(4)))[2] == ["b.pdf"]
+
+def test_collections_are_independent(tmp_path):
+    dedup = make_deduplicator(tmp_path)
+    text = make_text(1)
+    dedup.deduplicate(KB, "a.pdf", make_chunks(text))
+    assert dedup.deduplicate("other", "b.pdf", make_chunks(text))[1] == 0
+    dedup.reset(KB)
+    assert dedup.stats(KB)["indexed_chunks"] == 0
+    assert dedup.stats("other")["indexed_chunks"] == 1
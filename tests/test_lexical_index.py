@@ -0,0 +1,93 @@
+from lexical_index import LexicalIndex, looks_like_identifier, reciprocal_rank_fusion, tokenize
+
+KB = "knowledge_base"
+
+
+def make_index(tmp_path):
+    return LexicalIndex(str(tmp_path / "lexical.db"))
+
+
+def test_tokenize_keeps_identifiers_whole():
+    assert tokenize("Error E1234 in load_config()!") == ["error", "e1234", "in", "load_config"]
+
+def test_looks_like_identifier():
+    for word in ("E1234", "load_config", "QdrantClient", "HTTP", "utf8"):
+        assert looks_like_identifier(word), word
+    for word in ("why", "Chapter", "2", "1984", "OK", "_"):
+        assert not looks_like_identifier(word), word
+
+def test_search_ranks_by_bm25(tmp_path):
+    index = make_index(tmp_path)
+    index.replace_source(KB, "a.pdf", [
+        ("1", "the retry budget is exhausted when E1234 is raised", {}),
+        ("2", "E1234 E1234 means the cache is cold, see E1234 handling", {}),
+        ("3", "nothing relevant in this chunk", {}),
+    ])
+    results = index.search(KB, "e1234", k=10)
+    assert [point_id for point_id, _ in results] == ["2", "1"]
+    assert results[0][1] > results[1][1] > 0
+    assert index.search(KB, "missing words", k=10) == []
+    assert index.search(KB, "!!!", k=10) == []
+
+def test_terms_in_most_chunks_are_ignored(tmp_path):
+    index = make_index(tmp_path)
+    index.replace_source(KB, "a.pdf", [(str(i), f"the chapter {i}", {}) for i in range(12)])
+    assert index.search(KB, "the", k=5) == []
+    assert [point_id for point_id, _ in index.search(KB, "the 7", k=5)] == ["7"]
+
+def test_search_scope_filters_book_and_chapter(tmp_path):
+    index = make_index(tmp_path)
+    index.replace_source(KB, "a.pdf", [
+        ("a1", "gradient descent basics", {"book": "a", "chapter": "Intro"}),
+        ("a2", "gradient descent in depth", {"book": "a", "chapter": "Optimizers"}),
+    ])
+    index.replace_source(KB, "b.pdf", [("b1", "gradient descent again", {"book": "b", "chapter": "Intro"})])
+    def ids(scope):
+        return sorted(point_id for point_id, _ in index.search(KB, "gradient", k=10, scope=scope))
+    assert ids(None) == ["a1", "a2", "b1"]
+    assert ids({"book": "a"}) == ["a1", "a2"]
+    assert ids({"chapter": "Intro"}) == ["a1", "b1"]
+    assert ids({"book": "a", "chapter": "Intro"}) == ["a1"]
+
+def test_replace_and_remove_keep_stats_in_step(tmp_path):
+    index = make_index(tmp_path)
+    index.replace_source(KB, "a.pdf", [("1", "alpha beta", {}), ("2", "gamma", {})])
+    index.replace_source(KB, "b.pdf", [("3", "alpha", {})])
+    assert index.count(KB) == 3
+
+    index.replace_source(KB, "a.pdf", [("4", "delta", {})])
+    assert index.count(KB) == 2
+    assert [point_id for point_id, _ in index.search(KB, "alpha", k=10)] == ["3"]
+
+    index.remove_source(KB, "b.pdf")
+    assert index.count(KB) == 1
+    assert index.search(KB, "alpha", k=10) == []
+
+def test_add_takes_the_source_from_metadata(tmp_path):
+    index = make_index(tmp_path)
+    index.add(KB, [("1", "alpha", {"source_file": "a.pdf"}), ("2", "alpha", {"source_file": "b.pdf"})])
+    index.remove_source(KB, "a.pdf")
+    assert [point_id for point_id, _ in index.search(KB, "alpha", k=10)] == ["2"]
+
+def test_collections_are_partitioned_and_can_be_renamed(tmp_path):
+    index = make_index(tmp_path)
+    index.replace_source(KB, "a.pdf", [("old", "alpha", {})])
+    index.replace_source(KB + "_v2", "a.pdf", [("new", "alpha", {})])
+    assert [point_id for point_id, _ in index.search(KB, "alpha", k=10)] == ["old"]
+
+    index.rename_collection(KB + "_v2", KB)
+    assert [point_id for point_id, _ in index.search(KB, "alpha", k=10)] == ["new"]
+    assert index.count(KB) == 1 and index.count(KB + "_v2") == 0
+
+    index.reset(KB)
+    assert index.count(KB) == 0 and index.search(KB, "alpha", k=10) == []
+
+def test_reciprocal_rank_fusion_orders_by_combined_rank():
+    dense = ["a", "b", "c"]
+    lexical = ["c", "d", "a"]
+    # a: 1/61 + 1/63, c: 1/63 + 1/61 tie; a wins by insertion order; b (1/62) beats d (1/62) the same way
+    assert reciprocal_rank_fusion([dense, lexical], limit=4) == ["a", "c", "b", "d"]
+    assert reciprocal_rank_fusion([dense, lexical], limit=2) == ["a", "c"]
+    # An item ranked in both lists beats one ranked first in only one of them
+    assert reciprocal_rank_fusion([["x", "y"], ["y"]], limit=2) == ["y", "x"]
+    assert reciprocal_rank_fusion([[], []], limit=5) == []